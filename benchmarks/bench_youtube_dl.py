@@ -0,0 +1,44 @@
+"""Microbenchmark of the per-video yt-dlp setup in get_video_info: a new
+YoutubeDL per video vs the per-thread instance of get_youtube_dl. Only
+setup is timed -- no request is made. Run from the repository root:
+
+    python benchmarks/bench_youtube_dl.py [videos]
+"""
+import os
+import sys
+import time
+
+import yt_dlp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.query_youtube import get_youtube_dl  # noqa: E402
+
+YDL_OPTS = {"ignoreerrors": False, "quiet": True, "socket_timeout": 10}
+
+
+def setup_per_video():
+    """Setup of get_video_info before instances were reused."""
+    with yt_dlp.YoutubeDL(dict(YDL_OPTS)) as ydl:
+        return ydl.get_info_extractor("Youtube")
+
+
+def setup_reused():
+    return get_youtube_dl(YDL_OPTS).get_info_extractor("Youtube")
+
+
+def bench(func, videos):
+    start = time.perf_counter()
+    for _ in range(videos):
+        func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    videos = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    setup_reused()  # the one instance every later video reuses
+    per_video = bench(setup_per_video, videos)
+    reused = bench(setup_reused, videos)
+    print(f"{videos} videos")
+    print(f"new YoutubeDL per video: {per_video:.3f}s ({per_video / videos * 1000:.2f} ms/video)")
+    print(f"reused YoutubeDL:        {reused:.3f}s ({reused / videos * 1000:.3f} ms/video)")
@@ -1,11 +1,10 @@
 import contextlib
+import itertools
 import os
-import shutil
 import sys
 import time
 
 import qdarkstyle
-import requests
 from PyQt5.QtCore import QPersistentModelIndex, Qt, QThread, QUrl, pyqtSignal
 from PyQt5.QtGui import QDesktopServices, QImage, QPixmap
 from PyQt5.QtWidgets import (
@@ -69,23 +68,27 @@ class MainPage(QMainWindow, UiMainWindow):
     def url_loading_button_click(self):
         """Reads input data from self.url_input and creates an instance
         of the UrlLoading thread."""
-        # declare videos_dict upon loading url
-        self.videos_dict = {}
+        # declare video_records upon loading url
+        self.video_records = utils.VideoRecords()
         playlist_url = self._get_cell_text(self.url_input)
 
         self._reflect_url_loading_status()
         self.url_fetching_data_label.show()
         self.url_load = UrlLoading(playlist_url)
         self.url_load.loadStatus.connect(self._reflect_url_loading_status)
+        self.url_load.videoLoaded.connect(self._url_video_loaded)
+        self.url_load.videoFailed.connect(self._url_video_failed)
         self.url_load.countChanged.connect(self._url_loading_finished)
         self.url_load.start()
 
     def _reflect_url_loading_status(self, status=None):
         """Reflect YouTube url loading status. If no status is provided,
-        hide all error label and keep table content."""
-        self.video_table.clearContents()  # clear table content when loading
-        self.video_info_input.setText("")  # clear video info input cell
-        self._display_artwork(None)  # clear artwork display to default image
+        hide all error label and clear table content for a new load --
+        else rows loaded so far are kept."""
+        if not status:
+            self.video_table.clearContents()  # clear table content when loading
+            self.video_info_input.setText("")  # clear video info input cell
+            self._display_artwork(None)  # clear artwork display to default image
         self.url_poor_connection.hide()
         self.url_fetching_data_label.hide()
         self.url_reattempt_load_label.hide()
@@ -103,24 +106,38 @@ class MainPage(QMainWindow, UiMainWindow):
             self.revert_annotate.hide()
             self.itunes_annotate.show()  # refresh "Ask butler" button
 
-    def _url_loading_finished(self, videos_dict, is_executed):
-        """Retrieves data from thread when complete, updates GUI table."""
-        # First entry of self.videos_dict in MainPage class
-        self.videos_dict = videos_dict
-        self.video_table.clearContents()  # clear table for new loaded content
-        if is_executed:
-            self.default_annotate_table()  # set table content
-        else:
+    def _url_video_loaded(self, record):
+        """Append a video to the GUI table as soon as it is loaded, so
+        early rows can be edited while the rest of the playlist loads."""
+        if not self.video_records.add(record):  # i.e. a repeated video
+            return
+        row_index = len(self.video_records) - 1
+        if row_index >= self.video_table.rowCount():
+            self.video_table.setRowCount(row_index + 1)
+        self.video_table.setItem(row_index, 0, QTableWidgetItem(record.title))  # part of QWidget
+        for column_index in range(1, 5):
+            self.video_table.setItem(row_index, column_index, QTableWidgetItem("Unknown"))
+
+    def _url_video_failed(self, video_id, error_message):
+        """Report a video that could not be loaded -- the rest still are."""
+        print(f"Error: {video_id}: {error_message}")  # poor man's logging
+        self.video_info_input.setText(f"Could not load video {video_id}.")
+
+    def _url_loading_finished(self, video_records, is_executed):
+        """Retrieves data from thread when complete -- rows are already
+        in the GUI table."""
+        if not is_executed:
             self.url_error_label.show()
 
     def itunes_annotate_click(self):
         """Load iTunes annotation info on different thread."""
         self.video_info_input.setText("")
         # i.e. clicked annotate button with empty table
-        if not self._assert_videos_dict(self.video_info_input, "Could not get information."):
+        if not self._assert_video_records(self.video_info_input, "Could not get information."):
             return
 
-        self.annotate = iTunesLoading(self.videos_dict)
+        # a snapshot -- rows may still be loading
+        self.annotate = iTunesLoading(utils.VideoRecords(self.video_records))
         self.annotate.loadFinished.connect(self._itunes_annotate_finished)
         self.annotate.start()
 
@@ -168,14 +185,14 @@ class MainPage(QMainWindow, UiMainWindow):
 
     def default_annotate_table(self):
         """Default table annotation to video title in song columns"""
-        if not self.videos_dict:  # i.e. an invalid playlist input
+        if not self.video_records:  # i.e. an invalid playlist input
             self.video_table.clearContents()
             return
 
         self.video_info_input.setText("")
 
-        for index, key in enumerate(self.videos_dict):
-            self.video_table.setItem(index, 0, QTableWidgetItem(key))  # part of QWidget
+        for index, record in enumerate(self.video_records):
+            self.video_table.setItem(index, 0, QTableWidgetItem(record.title))  # part of QWidget
             self.video_table.setItem(index, 1, QTableWidgetItem("Unknown"))
             self.video_table.setItem(index, 2, QTableWidgetItem("Unknown"))
             self.video_table.setItem(index, 3, QTableWidgetItem("Unknown"))
@@ -190,18 +207,19 @@ class MainPage(QMainWindow, UiMainWindow):
 
     def download_button_click(self):
         """Executes when the button is clicked"""
-        # assert self.videos_dict exists
-        if not self._assert_videos_dict(self.download_status, "No video to download."):
+        # assert self.video_records exists
+        if not self._assert_video_records(self.download_status, "No video to download."):
             return
         playlist_properties = self._get_playlist_properties()
         self.download_button.setEnabled(False)
         self.download_status.setText("Downloading...")
         self.down = DownloadingVideos(
-            self.videos_dict,
+            utils.VideoRecords(self.video_records),  # a snapshot -- rows may still be loading
             self.download_dir,
             playlist_properties,
             self.save_as_mp4_box.isChecked(),
         )
+        self.down.downloadProgress.connect(self._download_progress)
         self.down.downloadCount.connect(self._download_finished)
         self.down.start()
 
@@ -209,7 +227,7 @@ class MainPage(QMainWindow, UiMainWindow):
         """Get video information from self.video_table to reflect to
         downloaded MP3 metadata."""
         playlist_properties = []
-        for row_index, _ in enumerate(self.videos_dict.items()):
+        for row_index in range(len(self.video_records)):
             song_properties = {}
             song_properties["song"] = self._get_cell_text(self.video_table.item(row_index, 0)).replace(
                 "/", "-"
@@ -223,6 +241,10 @@ class MainPage(QMainWindow, UiMainWindow):
 
         return playlist_properties
 
+    def _download_progress(self, finished, total):
+        """Show how many videos are downloaded so far."""
+        self.download_status.setText(f"Downloading... {finished}/{total}")
+
     def _download_finished(self, download_time):
         """Emit changes to MainPage once dowload is complete."""
         _min = int(download_time // 60)
@@ -259,11 +281,11 @@ class MainPage(QMainWindow, UiMainWindow):
         self.album_artwork.setAlignment(Qt.AlignCenter)
 
     def remove_selected_items(self):
-        """Removes the selected items from self.videos_table and self.videos_dict.
+        """Removes the selected items from self.videos_table and self.video_records.
         Table widget updates -- multiple row deletion capable."""
         video_list = []
-        if self._assert_videos_dict():
-            video_list = list(self.videos_dict.items())
+        if self._assert_video_records():
+            video_list = list(self.video_records)
 
         row_index_list = []
         for model_index in self.video_table.selectionModel().selectedRows():
@@ -271,8 +293,8 @@ class MainPage(QMainWindow, UiMainWindow):
             row_index = QPersistentModelIndex(model_index)
             row_index_list.append(row_index)
             with contextlib.suppress(IndexError, KeyError):
-                current_key = video_list[row][0]
-                del self.videos_dict[current_key]  # remove row item from self.videos_dict
+                current_id = video_list[row].id
+                self.video_records.remove(current_id)  # remove row item from self.video_records
         for index in row_index_list:
             self.video_table.removeRow(index.row())
 
@@ -313,11 +335,11 @@ class MainPage(QMainWindow, UiMainWindow):
         self.save_as_mp3_box.setChecked(False)
         self.save_as_mp4_box.setChecked(True)
 
-    def _assert_videos_dict(self, qline_edit_obj=None, text=""):
-        """Assert existence of `self.videos_dict` in current program state of caller.
+    def _assert_video_records(self, qline_edit_obj=None, text=""):
+        """Assert existence of `self.video_records` in current program state of caller.
         If not, display `text` to `qline_edit_obj` if `qline_edit_obj` provided."""
         try:
-            assert self.videos_dict
+            assert self.video_records
         except (AttributeError, AssertionError):
             if qline_edit_obj:
                 qline_edit_obj.setText(text)
@@ -350,41 +372,46 @@ class MainPage(QMainWindow, UiMainWindow):
 class UrlLoading(QThread):
     """Load video data from YouTube url."""
 
-    countChanged = pyqtSignal(dict, bool)
+    countChanged = pyqtSignal(object, bool)  # VideoRecords
+    videoLoaded = pyqtSignal(object)  # VideoRecord
+    videoFailed = pyqtSignal(str, str)  # video id, error message
     loadStatus = pyqtSignal(str)
 
     def __init__(self, playlist_link, parent=None):
         QThread.__init__(self, parent)
         self.playlist_link = playlist_link
-        self.reattempt_count = 0
-        self.override_error = False
 
     def run(self):
-        """Main function, gets all the playlist videos data, emits the info dict"""
-        # allow 5 reattempts if error in fetching YouTube videos
-        # else just get loaded videos by overriding error handling
-        if self.reattempt_count > 5:
-            self.override_error = True
-
+        """Main function, gets all the playlist videos data, emits each
+        video as it loads, then the info dict"""
+        # failures are retried with backoff within a deadline -- only what
+        # failed is loaded again, loaded rows are kept
         try:
-            videos_dict = utils.get_youtube_content(self.playlist_link, self.override_error)
-            if not videos_dict:
-                # if empty videos_dict returns, throw invalid url warning.
+            video_records = utils.VideoRecords()
+            for video_id, record in utils.iter_youtube_content_retrying(
+                self.playlist_link, on_retry=lambda _: self.loadStatus.emit("reattempt")
+            ):
+                if isinstance(record, Exception):
+                    self.videoFailed.emit(video_id, str(record))
+                    continue
+                if not video_records:
+                    self.loadStatus.emit("success")
+                video_records.add(record)
+                self.videoLoaded.emit(record)
+            if not video_records:
+                # if empty video_records returns, throw invalid url warning.
                 self.loadStatus.emit("invalid url")
             else:
-                self.loadStatus.emit("success")
-                self.countChanged.emit(videos_dict, True)
+                self.loadStatus.emit("success")  # i.e. hide a reattempt label
+                self.countChanged.emit(video_records, True)
 
-        except RuntimeError as error:  # handle error from video load fail
-            error_message = str(error)
-            if any(message in error_message for message in ["not a valid URL", "Unsupported URL", "list"]):
+        except RuntimeError as error:  # handle error from url load fail
+            # e.g. a bad url or a private, unavailable or removed video -- not retried
+            if utils.is_permanent_error(error) or "list" in str(error):
                 self.loadStatus.emit("invalid url")
-            elif "nodename nor servname provided" in error_message:
-                self.loadStatus.emit("server error")
             else:
-                self.loadStatus.emit("reattempt")
-                self.reattempt_count += 1
-                self.run()
+                # e.g. "nodename nor servname provided" -- out of retries
+                self.loadStatus.emit("server error")
 
 
 class iTunesLoading(QThread):
@@ -392,18 +419,17 @@ class iTunesLoading(QThread):
 
     loadFinished = pyqtSignal(tuple, bool)
 
-    def __init__(self, videos_dict, parent=None):
+    def __init__(self, video_records, parent=None):
         QThread.__init__(self, parent)
-        self.videos_dict = videos_dict
+        self.video_records = video_records
 
     def run(self):
-        """Multithread query to iTunes - return tuple."""
+        """Concurrent query to iTunes - return tuple."""
         try:
-            query_iter = ((row_index, key_value) for row_index, key_value in enumerate(self.videos_dict.items()))
+            query_iter = ((row_index, key_value) for row_index, key_value in enumerate(self.video_records.items()))
         except AttributeError:  # i.e. no content in table -- exit early
             return
-        itunes_query = utils.map_threads(utils.thread_query_itunes, query_iter)
-        itunes_query_tuple = tuple(itunes_query)
+        itunes_query_tuple = utils.annotate_itunes(query_iter)
         query_status = bool(self.check_itunes_nonetype(itunes_query_tuple))
         self.loadFinished.emit(itunes_query_tuple, query_status)
 
@@ -429,30 +455,20 @@ class ArtworkLoading(QThread):
         self.artwork_url = artwork_url
 
     def run(self):
-        artwork_img = bytes()
-        # get url response - if not url, return empty bytes
-        try:
-            response = requests.get(self.artwork_url)
-        except (requests.exceptions.MissingSchema, requests.exceptions.ConnectionError):
-            self.loadFinished.emit(artwork_img)
-            return
-
-        # check validity of url response - if ok return img byte content
-        if response.status_code != 200:  # invalid image url
-            self.loadFinished.emit(artwork_img)
-            return
-        artwork_img = response.content
+        # shares fetched artwork with tagging -- empty bytes if not a valid url
+        artwork_img = utils.get_artwork(self.artwork_url) or bytes()
         self.loadFinished.emit(artwork_img)
 
 
 class DownloadingVideos(QThread):
-    """Download all videos from the videos_dict using the id."""
+    """Download all videos from the video_records using the id."""
 
     downloadCount = pyqtSignal(float)  # attempt to emit delta_t
+    downloadProgress = pyqtSignal(int, int)  # videos finished, total
 
-    def __init__(self, videos_dict, download_path, playlist_properties, save_as_mp4, parent=None):
+    def __init__(self, video_records, download_path, playlist_properties, save_as_mp4, parent=None):
         QThread.__init__(self, parent)
-        self.videos_dict = videos_dict
+        self.video_records = video_records
         self.download_path = download_path
         self.playlist_properties = playlist_properties
         self.save_as_mp4 = save_as_mp4
@@ -480,10 +496,16 @@ class DownloadingVideos(QThread):
                 self.playlist_properties[index],
                 self.save_as_mp4,
             )
-            for index, key_value in enumerate(self.videos_dict.items())  # dict is naturally sorted in iteration
+            for index, key_value in enumerate(self.video_records.items())  # records keep row order
+        )
+        total = len(self.video_records)
+        finished = itertools.count(1)
+        utils.pipeline_query_youtube(
+            video_properties, callback=lambda *_: self.downloadProgress.emit(next(finished), total)
         )
-        utils.map_threads(utils.thread_query_youtube, video_properties)
-        shutil.rmtree(mp4_path)  # remove mp4 dir
+        # keep mp4 dir if partial downloads are left to resume on the next attempt
+        with contextlib.suppress(OSError):
+            os.rmdir(mp4_path)
         time1 = time.time()
 
         delta_t = time1 - time0
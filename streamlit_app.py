@@ -1,17 +1,21 @@
 import streamlit as st
 import pandas as pd
 import os
+import shutil
 import tempfile
 import zipfile
 from io import BytesIO
 import time
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import uuid
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Import utility functions
 from utils.query_youtube import get_youtube_content
-from utils.download_youtube import thread_query_youtube
-from utils.query_itunes import get_itunes_metadata, query_itunes
+from utils.download_youtube import pipeline_query_youtube
+from utils.annotate import annotate_itunes
+from utils.video_records import VideoRecords
 
 # Page configuration
 st.set_page_config(
@@ -119,9 +123,26 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+SCRATCH_PREFIX = "youtube2audio-mp4-"
+SCRATCH_MAX_AGE = 24 * 3600  # seconds
+
+def prune_scratch_dirs():
+    """Remove scratch folders left untouched for SCRATCH_MAX_AGE seconds --
+    their sessions are over and will never resume the partial downloads."""
+    for entry in os.scandir(tempfile.gettempdir()):
+        if not entry.name.startswith(SCRATCH_PREFIX):
+            continue
+        try:
+            if entry.is_dir() and time.time() - entry.stat().st_mtime > SCRATCH_MAX_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass  # removed meanwhile, e.g. by another session
+
 # Initialize session state
-if 'videos_dict' not in st.session_state:
-    st.session_state.videos_dict = {}
+if 'video_records' not in st.session_state:
+    st.session_state.video_records = VideoRecords()
+if 'annotations' not in st.session_state:
+    st.session_state.annotations = {}  # iTunes metadata by video id
 if 'download_progress' not in st.session_state:
     st.session_state.download_progress = {}
 if 'is_downloading' not in st.session_state:
@@ -130,6 +151,11 @@ if 'downloaded_files' not in st.session_state:
     st.session_state.downloaded_files = []
 if 'selected_videos' not in st.session_state:
     st.session_state.selected_videos = set()
+if 'mp4_temp_dir' not in st.session_state:
+    # Scratch folder of this session, kept across reruns so interrupted
+    # downloads resume -- sessions never share partial files
+    prune_scratch_dirs()
+    st.session_state.mp4_temp_dir = os.path.join(tempfile.gettempdir(), f"{SCRATCH_PREFIX}{uuid.uuid4().hex}")
 
 def format_duration(seconds):
     """Convert seconds to MM:SS format."""
@@ -143,103 +169,104 @@ def load_youtube_content(url, override_error=True):
     """Load YouTube content and update session state."""
     try:
         with st.spinner("Fetching video information..."):
-            videos_dict = get_youtube_content(url, override_error)
-            st.session_state.videos_dict = videos_dict
+            video_records = get_youtube_content(url, override_error)
+            st.session_state.video_records = video_records
+            st.session_state.annotations = {}
+            st.session_state.selected_videos = set()
             return True, "Videos loaded successfully!"
     except Exception as e:
         return False, f"Error loading videos: {str(e)}"
 
-def annotate_with_itunes(videos_dict):
-    """Annotate videos with iTunes metadata."""
+def annotate_with_itunes(video_records):
+    """Get iTunes metadata of videos by video id."""
     try:
         with st.spinner("Fetching iTunes metadata..."):
-            annotated_dict = {}
-            for title, video_info in videos_dict.items():
-                try:
-                    # Use the video URL to get iTunes metadata
-                    video_url = f"https://www.youtube.com/watch?v={video_info['id']}"
-                    itunes_data = get_itunes_metadata(video_url)
-                    if itunes_data:
-                        annotated_dict[title] = {
-                            **video_info,
-                            'artist': itunes_data.get('artist_name', 'Unknown Artist'),
-                            'album': itunes_data.get('album_name', 'Unknown Album'),
-                            'genre': itunes_data.get('primary_genre_name', 'Unknown Genre'),
-                            'artwork_url': itunes_data.get('artwork_url_fullres', '')
-                        }
-                    else:
-                        annotated_dict[title] = {
-                            **video_info,
-                            'artist': 'Unknown Artist',
-                            'album': 'Unknown Album',
-                            'genre': 'Unknown Genre',
-                            'artwork_url': ''
-                        }
-                except Exception as e:
-                    print(f"Error getting iTunes data for {title}: {e}")
-                    annotated_dict[title] = {
-                        **video_info,
+            # Look up all videos concurrently
+            itunes_results = dict(annotate_itunes(enumerate(video_records.items())))
+            annotations = {}
+            for row_index, record in enumerate(video_records):
+                itunes_data = itunes_results.get(row_index)
+                if itunes_data:
+                    annotations[record.id] = {
+                        'artist': itunes_data.get('artist_name', 'Unknown Artist'),
+                        'album': itunes_data.get('album_name', 'Unknown Album'),
+                        'genre': itunes_data.get('primary_genre_name', 'Unknown Genre'),
+                        'artwork_url': itunes_data.get('artwork_url_fullres', ''),
+                        'artwork_bytes': itunes_data.get('artwork_bytes_fullres')
+                    }
+                else:
+                    annotations[record.id] = {
                         'artist': 'Unknown Artist',
                         'album': 'Unknown Album',
                         'genre': 'Unknown Genre',
                         'artwork_url': ''
                     }
-            return annotated_dict
+            return annotations
     except Exception as e:
         st.error(f"Error fetching iTunes metadata: {str(e)}")
-        return videos_dict
+        return st.session_state.annotations
+
+def video_annotation(record):
+    """Get iTunes metadata of a video, else the song fields from YouTube."""
+    return st.session_state.annotations.get(record.id) or {
+        'artist': record.get('artist', 'Unknown Artist'),
+        'album': record.get('album', 'Unknown Album'),
+        'genre': 'Unknown Genre',
+    }
 
-def download_videos(videos_dict, save_as_mp4=False):
+def download_videos(video_records, save_as_mp4=False):
     """Download videos using threading."""
     st.session_state.is_downloading = True
     st.session_state.downloaded_files = []
     
     # Create temporary directory for downloads
     temp_dir = tempfile.mkdtemp()
-    mp4_temp_dir = tempfile.mkdtemp()
+    mp4_temp_dir = st.session_state.mp4_temp_dir
+    os.makedirs(mp4_temp_dir, exist_ok=True)
     
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    total_videos = len(videos_dict)
+    total_videos = len(video_records)
     completed = 0
     
-    def download_single_video(item):
+    def download_properties(record):
+        annotation = video_annotation(record)
+        song_properties = {
+            'song': record.title,
+            'artist': annotation['artist'],
+            'album': annotation['album'],
+            'genre': annotation['genre'],
+            'artwork': annotation.get('artwork_url', ''),
+            'artwork_bytes': annotation.get('artwork_bytes')
+        }
+        return (
+            (record.title, record),
+            (temp_dir, mp4_temp_dir),
+            song_properties,
+            save_as_mp4
+        )
+    
+    script_run_ctx = get_script_run_ctx()
+    progress_lock = threading.Lock()
+
+    def update_progress(args, result):
+        """Move the progress bar as each video finishes -- called from the
+        pipeline's worker threads, which need the script's context to draw."""
         nonlocal completed
-        try:
-            title, video_info = item
-            song_properties = {
-                'song': title,
-                'artist': video_info.get('artist', 'Unknown Artist'),
-                'album': video_info.get('album', 'Unknown Album'),
-                'genre': video_info.get('genre', 'Unknown Genre'),
-                'artwork_url': video_info.get('artwork_url', '')
-            }
-            
-            args = [
-                (title, video_info),
-                (temp_dir, mp4_temp_dir),
-                song_properties,
-                save_as_mp4
-            ]
-            
-            result = thread_query_youtube(args)
-            
-            completed += 1
-            progress = completed / total_videos
-            progress_bar.progress(progress)
-            status_text.text(f"Downloaded: {title} ({completed}/{total_videos})")
-            
-            return result
-            
-        except Exception as e:
-            st.error(f"Error downloading {title}: {str(e)}")
+        add_script_run_ctx(threading.current_thread(), script_run_ctx)
+        with progress_lock:
             completed += 1
-            return None
-    
-    # Download videos using ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        results = list(executor.map(download_single_video, videos_dict.items()))
+            if isinstance(result, Exception):
+                st.error(f"Error downloading {args[0][0]}: {str(result)}")
+            progress_bar.progress(completed / total_videos)
+            status_text.text(f"Downloaded: {args[0][0]} ({completed}/{total_videos})")
+
+    # Download on network threads, encode on a process pool (see config.STREAM_TRANSCODE)
+    results = pipeline_query_youtube(
+        (download_properties(record) for record in video_records), callback=update_progress
+    )
+    status_text.text(f"Processed {completed}/{total_videos} videos")
     
     # Collect downloaded files
     downloaded_files = []
@@ -252,10 +279,11 @@ def download_videos(videos_dict, save_as_mp4=False):
     st.session_state.downloaded_files = downloaded_files
     st.session_state.is_downloading = False
     
-    # Clean up temp directories
-    import shutil
+    # Clean up temp directories -- the scratch folder only once no failed
+    # download is left to resume
     shutil.rmtree(temp_dir, ignore_errors=True)
-    shutil.rmtree(mp4_temp_dir, ignore_errors=True)
+    if not any(isinstance(result, Exception) for _, result in results):
+        shutil.rmtree(mp4_temp_dir, ignore_errors=True)
     
     return downloaded_files
 
@@ -310,17 +338,18 @@ if load_button and url_input:
         st.error(message)
 
 # Display videos table if videos are loaded
-if st.session_state.videos_dict:
+if st.session_state.video_records:
     st.markdown('<h2 class="section-header">Loaded Videos</h2>', unsafe_allow_html=True)
     
     # iTunes annotation button
     if use_itunes:
         if st.button("Annotate with iTunes Metadata", use_container_width=False):
-            st.session_state.videos_dict = annotate_with_itunes(st.session_state.videos_dict)
+            st.session_state.annotations = annotate_with_itunes(st.session_state.video_records)
             st.success("iTunes metadata added!")
     
     # Display videos with individual selection checkboxes
-    for title, info in st.session_state.videos_dict.items():
+    for record in st.session_state.video_records:
+        title, info = record.title, video_annotation(record)
         # Create a card-like container
         with st.container():
             col1, col2 = st.columns([0.08, 0.92])
@@ -328,15 +357,15 @@ if st.session_state.videos_dict:
             with col1:
                 is_selected = st.checkbox(
                     "",
-                    value=title in st.session_state.selected_videos,
-                    key=f"select_{title}",
+                    value=record.id in st.session_state.selected_videos,
+                    key=f"select_{record.id}",
                     label_visibility="collapsed"
                 )
                 
-                if is_selected and title not in st.session_state.selected_videos:
-                    st.session_state.selected_videos.add(title)
-                elif not is_selected and title in st.session_state.selected_videos:
-                    st.session_state.selected_videos.remove(title)
+                if is_selected and record.id not in st.session_state.selected_videos:
+                    st.session_state.selected_videos.add(record.id)
+                elif not is_selected and record.id in st.session_state.selected_videos:
+                    st.session_state.selected_videos.remove(record.id)
             
             with col2:
                 st.markdown(f'<div class="video-title">{title}</div>', unsafe_allow_html=True)
@@ -344,7 +373,7 @@ if st.session_state.videos_dict:
                 # Video info in a clean layout
                 info_col1, info_col2, info_col3, info_col4 = st.columns(4)
                 with info_col1:
-                    st.markdown(f"**Duration:** {format_duration(info.get('duration'))}")
+                    st.markdown(f"**Duration:** {format_duration(record.duration)}")
                 with info_col2:
                     st.markdown(f"**Artist:** {info.get('artist', 'Unknown')}")
                 with info_col3:
@@ -360,7 +389,7 @@ if st.session_state.videos_dict:
     
     with col1:
         if st.button("Select All", use_container_width=True):
-            st.session_state.selected_videos = set(st.session_state.videos_dict.keys())
+            st.session_state.selected_videos = {record.id for record in st.session_state.video_records}
             st.rerun()
     
     with col2:
@@ -377,12 +406,12 @@ if st.session_state.videos_dict:
     # Download functionality
     if 'download_button' in locals() and download_button:
         if st.session_state.selected_videos:
-            # Filter videos_dict to only include selected videos
-            selected_videos_dict = {title: info for title, info in st.session_state.videos_dict.items() 
-                                  if title in st.session_state.selected_videos}
+            # Filter video_records to only include selected videos
+            selected_records = VideoRecords(record for record in st.session_state.video_records
+                                            if record.id in st.session_state.selected_videos)
             
             with st.spinner("Preparing downloads..."):
-                downloaded_files = download_videos(selected_videos_dict, save_as_mp4)
+                downloaded_files = download_videos(selected_records, save_as_mp4)
             
             if downloaded_files:
                 st.success(f"Successfully downloaded {len(downloaded_files)} audio files!")
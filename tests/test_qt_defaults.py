@@ -2,12 +2,14 @@
 import os
 import sys
 import unittest
+from unittest import mock
 
 from PyQt5.QtWidgets import QApplication
 
 # get directory to main.py
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import main
+import utils
 
 app = QApplication(sys.argv)
 
@@ -66,6 +68,31 @@ class testMain(unittest.TestCase):
         """Test default artwork label"""
         self.assertEqual(self.form.album_artwork.text(), "")
 
+    def test_progressive_rows(self):
+        """Test loaded videos are appended to the table one by one"""
+        self.form.video_records = utils.VideoRecords()
+        self.form._url_video_loaded(utils.VideoRecord("a", "Song A", 100))
+        self.form._url_video_loaded(utils.VideoRecord("b", "Song B", 200))
+        self.form._url_video_loaded(utils.VideoRecord("a", "Song A", 100))
+        self.assertEqual([record.id for record in self.form.video_records], ["a", "b"])
+        self.assertEqual(self.form.video_table.item(1, 0).text(), "Song B")
+        self.assertEqual(self.form.video_table.item(1, 4).text(), "Unknown")
+        self.assertIsNone(self.form.video_table.item(2, 0))
+
+    def test_load_error_status(self):
+        """Test permanent url errors show as invalid, exhausted retries as a poor connection"""
+        for error, status in (
+            (RuntimeError("ERROR: [youtube] abc: Private video"), "invalid url"),
+            (RuntimeError("ERROR: [youtube] abc: Video unavailable"), "invalid url"),
+            (RuntimeError("Connection reset by peer"), "server error"),
+        ):
+            statuses = []
+            url_load = main.UrlLoading("https://www.youtube.com/watch?v=abc")
+            url_load.loadStatus.connect(statuses.append)
+            with mock.patch.object(utils, "iter_youtube_content_retrying", side_effect=error):
+                url_load.run()
+            self.assertEqual(statuses, [status])
+
     def test_hyperlink_label(self):
         """Test default label on source code hyperlink"""
         self.assertEqual(
@@ -1,11 +1,39 @@
 """Test functions in utils/ directory"""
+import concurrent.futures
 import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4
 
 # get base directory and import util files
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import _threading, download_youtube, query_itunes, query_youtube
+from utils import (
+    _threading,
+    annotate,
+    artwork_cache,
+    config,
+    download_youtube,
+    http_client,
+    media_cache,
+    partial_download,
+    query_itunes,
+    query_youtube,
+    rate_limit,
+    single_flight,
+    sqlite_cache,
+    timeout,
+    transcode,
+    video_records,
+)
 
 
 class testThreading(unittest.TestCase):
@@ -24,6 +52,79 @@ class testThreading(unittest.TestCase):
         total_value_sum_one = _threading.map_threads(self.example_func_for_threading, iterable)
         self.assertEqual(len(list(total_value_sum_one)), 500)
 
+    def test_imap_threads(self):
+        """Test _threading.imap_threads yields every item as it completes"""
+        progress = []
+        results = list(
+            _threading.imap_threads(
+                lambda value: 1 / value, range(-3, 3), callback=lambda *result: progress.append(result)
+            )
+        )
+        self.assertEqual(sorted(index for index, _ in results), list(range(6)))
+        self.assertIsInstance(dict(results)[3], ZeroDivisionError)
+        self.assertEqual(progress, results)
+
+    def test_imap_threads_backpressure(self):
+        """Test _threading.imap_threads reads the input as items complete"""
+        consumed = []
+
+        def generator():
+            for value in range(100):
+                consumed.append(value)
+                yield value
+
+        results = _threading.imap_threads(self.example_func_for_threading, generator(), max_pending=4)
+        next(results)
+        self.assertLessEqual(len(consumed), 5)
+        self.assertEqual(len(list(results)), 99)
+
+    def test_pipeline(self):
+        """Test _threading.map_pipeline passes every item through both stages"""
+        iterable = [i for i in range(50)]
+        # process stage function must be picklable -- use a builtin
+        results = _threading.map_pipeline(lambda value: -value, abs, iterable, queue_size=2)
+        self.assertEqual(sorted(results), [(i, i) for i in iterable])
+
+    def test_pipeline_errors(self):
+        """Test _threading.map_pipeline returns exceptions of failed items"""
+        results = dict(_threading.map_pipeline(lambda value: 1 / value, abs, [0, 1]))
+        self.assertIsInstance(results[0], ZeroDivisionError)
+        self.assertEqual(results[1], 1)
+
+    def test_broken_executor(self):
+        """Test a broken pool is replaced on submit"""
+        broken = mock.Mock(submit=mock.Mock(side_effect=concurrent.futures.BrokenExecutor))
+        _threading._executors["metadata"] = broken
+        try:
+            self.assertEqual(_threading.submit("metadata", abs, -1).result(), 1)
+            self.assertIsNot(_threading.get_executor("metadata"), broken)
+        finally:
+            _threading.shutdown_executors()
+
+    def test_executor_registry(self):
+        """Test named pools are long-lived, sized from config and shut down"""
+        workers = config.NETWORK_WORKERS
+        config.NETWORK_WORKERS = 3
+        try:
+            _threading.shutdown_executors()
+            executor = _threading.get_executor("network")
+            self.assertIs(executor, _threading.get_executor("network"))
+            self.assertEqual(_threading.pool_workers("network"), 3)
+            # all three workers run at once
+            barrier = threading.Barrier(3, timeout=5)
+            _threading.map_threads(lambda _: barrier.wait(), range(3), pool="network")
+            _threading.shutdown_executors()
+            self.assertIsNot(executor, _threading.get_executor("network"))
+            # Python 3.8 executors take no cancel_futures
+            legacy = mock.create_autospec(lambda wait=True: None)
+            _threading._executors["legacy"] = mock.Mock(shutdown=legacy)
+            with mock.patch.object(_threading.sys, "version_info", (3, 8)):
+                _threading.shutdown_executors()
+            legacy.assert_called_once_with(wait=True)
+        finally:
+            config.NETWORK_WORKERS = workers
+            _threading.shutdown_executors()
+
 
 class testYouTubeQuery(unittest.TestCase):
     """Test utils/youtube_query.py"""
@@ -43,8 +144,8 @@ class testYouTubeQuery(unittest.TestCase):
         try:
             youtube_video_dict = query_youtube.get_youtube_content(self.playlist_url, override_error)
         except RuntimeError:  # successfully threw RuntimeError
-            youtube_video_dict = {}
-        self.assertIsInstance(youtube_video_dict, dict)
+            youtube_video_dict = video_records.VideoRecords()
+        self.assertIsInstance(youtube_video_dict, video_records.VideoRecords)
 
     def test_get_youtube_video_content_false_override(self):
         """Test query_youtube.get_youtube_content with false error override
@@ -53,28 +154,177 @@ class testYouTubeQuery(unittest.TestCase):
         try:
             youtube_video_dict = query_youtube.get_youtube_content(self.video_url, override_error)
         except RuntimeError:
-            youtube_video_dict = {}
-        self.assertIsInstance(youtube_video_dict, dict)
+            youtube_video_dict = video_records.VideoRecords()
+        self.assertIsInstance(youtube_video_dict, video_records.VideoRecords)
 
     def test_get_youtube_playlist_content_true_override(self):
         """Test query_youtube.get_youtube_content with error override
         for a playlist url"""
         override_error = True
         youtube_video_dict = query_youtube.get_youtube_content(self.playlist_url, override_error)
-        self.assertIsInstance(youtube_video_dict, dict)
+        self.assertIsInstance(youtube_video_dict, video_records.VideoRecords)
 
     def test_get_youtube_video_content_true_override(self):
         """Test query_youtube.get_youtube_content with error override
         for a video url"""
         override_error = True
         youtube_video_dict = query_youtube.get_youtube_content(self.video_url, override_error)
-        self.assertIsInstance(youtube_video_dict, dict)
+        self.assertIsInstance(youtube_video_dict, video_records.VideoRecords)
 
     def test_get_playlist_video_info(self):
         """Test fetching individual urls in a playlist url"""
         youtube_playlist_videos_tuple = query_youtube.get_playlist_video_info(self.playlist_url)
         self.assertIsInstance(youtube_playlist_videos_tuple, tuple)
 
+    def mock_playlist(self, entries):
+        """Serve a flat playlist of entries from a mock YoutubeDL, with the
+        video and playlist caches in a temporary folder"""
+        ydl = mock.Mock()
+        ydl.extract_info.side_effect = lambda *args, **kwargs: {"entries": iter(entries)}
+        tmp_dirpath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dirpath, ignore_errors=True)
+        path = os.path.join(tmp_dirpath, "youtube.sqlite3")
+        self.video_cache = sqlite_cache.SQLiteCache(path, "videos", 60)
+        self.playlist_cache = sqlite_cache.SQLiteCache(path, "playlists", 60)
+        for attribute, value in (
+            ("get_youtube_dl", mock.Mock(return_value=ydl)),
+            ("get_video_cache", lambda: self.video_cache),
+            ("get_playlist_cache", lambda: self.playlist_cache),
+        ):
+            patcher = mock.patch.object(query_youtube, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return ydl
+
+    def test_flat_playlist_extraction(self):
+        """Test a playlist is read from flat entries in one extraction"""
+        entry = {"id": "KlmPOxwoC6Y", "title": "Bob Marley - Blackman Redemption", "duration": 212}
+        ydl = self.mock_playlist([entry, None])
+        self.assertEqual(list(query_youtube.iter_playlist_entries(self.playlist_url)), [entry])
+        self.assertEqual(ydl.extract_info.call_count, 1)
+        self.assertEqual(query_youtube.get_youtube_dl.call_args[0][0]["extract_flat"], "in_playlist")
+        self.assertEqual(
+            list(query_youtube.video_content_to_records([entry])),
+            [video_records.VideoRecord("KlmPOxwoC6Y", "Bob Marley - Blackman Redemption", 212)],
+        )
+
+    def test_iter_playlist_content(self):
+        """Test playlist videos are yielded one by one, unavailable ones as errors"""
+        self.mock_playlist(
+            [
+                {"id": "KlmPOxwoC6Y", "title": "Bob Marley - Blackman Redemption", "duration": 212},
+                {"id": "xxxxxxxxxxx", "title": "[Private video]", "duration": None},
+            ]
+        )
+        records = list(query_youtube.iter_youtube_content(self.playlist_url, override_error=False))
+        record = video_records.VideoRecord("KlmPOxwoC6Y", "Bob Marley - Blackman Redemption", 212)
+        self.assertEqual(records[0], ("KlmPOxwoC6Y", record))
+        self.assertEqual(records[1][0], "xxxxxxxxxxx")
+        self.assertIsInstance(records[1][1], RuntimeError)
+        self.assertEqual(list(query_youtube.iter_youtube_content(self.playlist_url, True)), records[:1])
+        self.assertEqual(
+            query_youtube.get_playlist_video_info(self.playlist_url), ("https://www.youtube.com/watch?v=KlmPOxwoC6Y",)
+        )
+
+    def test_playlist_reload(self):
+        """Test a reload reads the membership again, reusing cached video metadata"""
+        entries = [
+            {"id": "KlmPOxwoC6Y", "title": "Bob Marley - Blackman Redemption", "duration": 212},
+            {"id": "woG54UNJRrE", "title": "The Police - No Time This Time", "duration": 198},
+        ]
+        ydl = self.mock_playlist(entries)
+        self.assertIsNone(query_youtube.get_playlist_changes(self.playlist_url))
+        list(query_youtube.iter_youtube_content(self.playlist_url, override_error=False))
+        self.assertEqual(query_youtube.get_playlist_changes(self.playlist_url), (("KlmPOxwoC6Y", "woG54UNJRrE"), ()))
+
+        self.video_cache.put("woG54UNJRrE", dict(entries[1], artist="The Police"))
+        entries[0] = {"id": "nbXACcsTn84", "title": "The Police - Walking On The Moon", "duration": 300}
+        records = dict(query_youtube.iter_youtube_content(self.playlist_url, override_error=False))
+        self.assertEqual(ydl.extract_info.call_count, 2)
+        self.assertEqual(list(records), ["nbXACcsTn84", "woG54UNJRrE"])
+        self.assertEqual(records["woG54UNJRrE"].artist, "The Police")
+        self.assertEqual(query_youtube.get_playlist_changes(self.playlist_url), (("nbXACcsTn84",), ("KlmPOxwoC6Y",)))
+
+    def test_load_deadline(self):
+        """Test a url load stops fetching playlist pages at its deadline"""
+
+        def slow_entries():
+            for index in range(10):
+                time.sleep(0.05)
+                yield {"id": f"video{index}", "title": f"Video {index}", "duration": 60}
+
+        self.mock_playlist(slow_entries())
+        loaded = []
+        start = time.monotonic()
+        with self.assertRaises(RuntimeError):
+            for video_id, _ in query_youtube.iter_youtube_content_retrying(self.playlist_url, deadline=0.12):
+                loaded.append(video_id)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertTrue(0 < len(loaded) < 10)
+        self.assertIsNone(timeout.current_deadline().remaining())  # the scope didn't leak into the caller
+
+    def test_retry_failed_items(self):
+        """Test only what failed is loaded again, with backoff"""
+        record = video_records.VideoRecord("KlmPOxwoC6Y", "Bob Marley - Blackman Redemption", 212)
+        loads = []
+
+        def iter_youtube_content(youtube_url, override_error):
+            loads.append(youtube_url)
+            yield record.id, record
+            yield "flakyflaky1", RuntimeError("HTTP Error 503")
+            yield "privatevid1", RuntimeError("Video unavailable: privatevid1")
+            if len(loads) == 1:
+                raise RuntimeError("Connection reset by peer")
+
+        retried = []
+        backoff_base = config.BACKOFF_BASE
+        config.BACKOFF_BASE = 0.01
+        try:
+            with mock.patch.object(query_youtube, "iter_youtube_content", iter_youtube_content), mock.patch.object(
+                query_youtube, "get_video_info", return_value={"id": "flakyflaky1", "title": "Flaky", "duration": 1}
+            ) as get_video_info:
+                results = dict(
+                    query_youtube.iter_youtube_content_retrying(self.playlist_url, on_retry=retried.append)
+                )
+        finally:
+            config.BACKOFF_BASE = backoff_base
+        self.assertEqual(len(loads), 2)  # the url load failed once
+        self.assertEqual(get_video_info.call_count, 1)  # the private video is not retried
+        self.assertEqual(results[record.id], record)
+        self.assertEqual(results["flakyflaky1"].title, "Flaky")
+        self.assertIsInstance(results["privatevid1"], RuntimeError)
+        self.assertEqual(len(retried), 2)
+
+    def test_video_cache(self):
+        """Test trimmed video metadata is cached by video id"""
+        video_info = {
+            "id": "woG54UNJRrE",
+            "title": "The Police - No Time This Time",
+            "duration": 198,
+            "description": "not cached",
+            "formats": [
+                {"format_id": "140", "ext": "m4a", "acodec": "mp4a.40.2", "vcodec": "none", "abr": 129.5},
+                {"format_id": "18", "ext": "mp4", "acodec": "mp4a.40.2", "vcodec": "avc1.42001E"},
+            ],
+        }
+        ydl = mock.Mock()
+        ydl.extract_info.return_value = video_info
+        tmp_dirpath = tempfile.mkdtemp()
+        video_cache = sqlite_cache.SQLiteCache(os.path.join(tmp_dirpath, "youtube.sqlite3"), "videos", 60)
+        try:
+            with mock.patch.object(query_youtube, "get_youtube_dl", return_value=ydl), mock.patch.object(
+                query_youtube, "get_video_cache", return_value=video_cache
+            ):
+                first = query_youtube.get_video_info((self.video_url, False))
+                second = query_youtube.get_video_info((self.video_url, False))
+        finally:
+            shutil.rmtree(tmp_dirpath, ignore_errors=True)
+        self.assertEqual(ydl.extract_info.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertNotIn("description", first)
+        self.assertNotIn("formats", first)
+        self.assertEqual(query_youtube.url_video_id("https://youtu.be/woG54UNJRrE"), "woG54UNJRrE")
+
     def test_get_video_info_false_override(self):
         """Test getting video information with false error override"""
         override_error = False
@@ -92,11 +342,27 @@ class testYouTubeQuery(unittest.TestCase):
         video_info = query_youtube.get_video_info(args)
         self.assertIsInstance(video_info, dict)
 
-    def test_video_content_to_dict(self):
+    def test_get_youtube_dl(self):
+        """Test YoutubeDL instances are reused per thread and per options"""
+        strict = query_youtube.get_youtube_dl({"ignoreerrors": False, "quiet": True})
+        self.assertIs(strict, query_youtube.get_youtube_dl({"quiet": True, "ignoreerrors": False}))
+        lenient = query_youtube.get_youtube_dl({"ignoreerrors": True, "quiet": True})
+        self.assertIsNot(strict, lenient)
+        self.assertTrue(lenient.params["ignoreerrors"])
+        other_thread = []
+        thread = threading.Thread(
+            target=lambda: other_thread.append(query_youtube.get_youtube_dl({"ignoreerrors": False, "quiet": True}))
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(strict, other_thread[0])
+
+    def test_video_content_to_records(self):
         """Test a list of video info dictionaries is successfully converted
-        to a dict type"""
-        video_list_to_dict = query_youtube.video_content_to_dict(self.video_info_list)
-        self.assertIsInstance(video_list_to_dict, dict)
+        to VideoRecords"""
+        video_list_to_records = query_youtube.video_content_to_records(self.video_info_list)
+        self.assertIsInstance(video_list_to_records, video_records.VideoRecords)
+        self.assertEqual(len(video_list_to_records), 2)
 
 
 class testiTunesQuery(unittest.TestCase):
@@ -122,6 +388,24 @@ class testiTunesQuery(unittest.TestCase):
         self.assertEqual(return_row_index, 0)
         self.assertIsInstance(return_itunes_json, dict)
 
+    def test_annotate_itunes(self):
+        """Test concurrent annotation returns one result per row"""
+        rows = [(row_index, self.youtube_video_key_value) for row_index in range(4)]
+        finished = []
+        results = annotate.annotate_itunes(rows, concurrency=2, callback=lambda *result: finished.append(result))
+        self.assertEqual(sorted(row_index for row_index, _ in results), [0, 1, 2, 3])
+        self.assertEqual(sorted(finished), sorted(results))
+
+    def test_video_search_term(self):
+        """Test search terms come from the loaded video record, not oEmbed"""
+        title, video = self.youtube_video_key_value
+        self.assertEqual(query_itunes.video_search_term(title, video), title)
+        song = {**video, "artist": "Bob Marley & The Wailers", "track": "Blackman Redemption"}
+        self.assertEqual(
+            query_itunes.video_search_term(title, song), "Bob Marley & The Wailers Blackman Redemption"
+        )
+        self.assertIsNone(query_itunes.video_search_term("", video))
+
     def test_get_itunes_metadata(self):
         """Test retrieving iTunes metadata as a high level function"""
         itunes_meta_data = query_itunes.get_itunes_metadata(self.video_url_for_oembed)
@@ -213,5 +497,791 @@ class testYouTubeDownload(unittest.TestCase):
     # TODO: add tests for mp3 and mp4 annotations -- above tests are for high-level functions.
 
 
+class FakeStream:
+    """Minimal stand-in for a pytube Stream"""
+
+    def __init__(self, itag, audio_codec, abr, video_codec=None):
+        self.itag = itag
+        self.audio_codec = audio_codec
+        self.video_codec = video_codec
+        self.abr = abr
+        self.bitrate = None
+        self.is_default_audio_track = video_codec is None
+
+
+class FakeStreamQuery:
+    """Minimal stand-in for a pytube StreamQuery"""
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def filter(self, only_audio=False):
+        return [stream for stream in self.streams if not (only_audio and stream.video_codec)]
+
+    def get_highest_resolution(self):
+        return next(stream for stream in self.streams if stream.video_codec)
+
+
+class testAudioStreamSelection(unittest.TestCase):
+    """Test download_youtube.select_audio_stream"""
+
+    def setUp(self):
+        self.video = FakeStream(18, "mp4a.40.2", None, video_codec="avc1.42001E")
+        self.streams = FakeStreamQuery(
+            [
+                self.video,
+                FakeStream(139, "mp4a.40.5", "48kbps"),
+                FakeStream(140, "mp4a.40.2", "128kbps"),
+                FakeStream(251, "opus", "160kbps"),
+            ]
+        )
+
+    def test_codec_preference(self):
+        """Test preferred codec wins over a higher bitrate"""
+        stream = download_youtube.select_audio_stream(self.streams, codec_preference=("mp4a", "opus"))
+        self.assertEqual(stream.itag, 140)
+        stream = download_youtube.select_audio_stream(self.streams, codec_preference=("opus", "mp4a"))
+        self.assertEqual(stream.itag, 251)
+
+    def test_max_bitrate(self):
+        """Test bitrate cap excludes larger streams"""
+        stream = download_youtube.select_audio_stream(self.streams, codec_preference=("opus",), max_bitrate=128)
+        self.assertEqual(stream.itag, 140)
+
+    def test_video_fallback(self):
+        """Test video stream is only used as an explicit fallback"""
+        video_only = FakeStreamQuery([self.video])
+        with self.assertRaises(RuntimeError):
+            download_youtube.select_audio_stream(video_only, video_fallback=False)
+        stream = download_youtube.select_audio_stream(video_only, video_fallback=True)
+        self.assertIs(stream, self.video)
+
+
+class testTranscode(unittest.TestCase):
+    """Test utils/transcode.py"""
+
+    def setUp(self):
+        self.tmp_dirpath = tempfile.mkdtemp()
+
+    def make_media(self, filename, *codec_args):
+        """Write a one second test clip with FFmpeg"""
+        path = os.path.join(self.tmp_dirpath, filename)
+        command = [transcode.ffmpeg_binary(), "-y", "-loglevel", "error"]
+        command += ["-f", "lavfi", "-i", "sine=duration=1", "-f", "lavfi", "-i", "color=duration=1:size=64x64"]
+        transcode.run_ffmpeg(command + list(codec_args) + [path])
+        return path
+
+    def test_remux_aac_video(self):
+        """Test remux drops the video track and keeps AAC untouched"""
+        source = self.make_media("video.mp4", "-c:a", "aac", "-c:v", "mpeg4")
+        target = transcode.transcode_audio(source, os.path.join(self.tmp_dirpath, "audio.m4a"), True, "mp4a.40.2")
+        audio = MP4(target)
+        self.assertTrue(audio.info.codec.startswith("mp4a"))
+        self.assertLess(os.path.getsize(target), os.path.getsize(source))
+
+    def test_remux_opus(self):
+        """Test remux of Opus audio into an M4A container"""
+        source = self.make_media("audio.webm", "-map", "0:a", "-c:a", "libopus")
+        target = transcode.transcode_audio(source, os.path.join(self.tmp_dirpath, "audio.m4a"), True, "opus")
+        self.assertEqual(MP4(target).info.codec.lower(), "opus")
+
+    def read_chunks(self, path, fail=False):
+        """Yield file content in small chunks, like a download"""
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(4096), b""):
+                yield chunk
+        if fail:
+            raise ConnectionError("connection dropped")
+
+    def test_stream_transcode_mp3(self):
+        """Test MP3 encode from chunks piped into FFmpeg"""
+        source = self.make_media("audio.webm", "-map", "0:a", "-c:a", "libopus")
+        target = os.path.join(self.tmp_dirpath, "audio.mp3")
+        transcode.stream_transcode(self.read_chunks(source), target, False, "opus")
+        self.assertGreater(MP3(target).info.length, 0.5)
+
+    def test_stream_transcode_failed_download(self):
+        """Test a failed download leaves no partial output"""
+        source = self.make_media("audio.m4a", "-map", "0:a", "-c:a", "aac")
+        target = os.path.join(self.tmp_dirpath, "out.m4a")
+        with self.assertRaises(ConnectionError):
+            transcode.stream_transcode(self.read_chunks(source, fail=True), target, True, "mp4a.40.2")
+        self.assertFalse(os.path.exists(target))
+
+    def test_transcode_timeout(self):
+        """Test a slow encode is killed and leaves no partial output"""
+        target = os.path.join(self.tmp_dirpath, "long.mp3")
+        command = [transcode.ffmpeg_binary(), "-y", "-loglevel", "error", "-re"]
+        command += ["-f", "lavfi", "-i", "sine=duration=60", target]
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            transcode.run_ffmpeg(command, timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(os.path.exists(target))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dirpath, ignore_errors=True)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serve `content` with Range support, dropping the connection after
+    `drop_after` bytes of a response if set."""
+
+    content = bytes(range(256)) * 4096
+    drop_after = None
+    served = 0
+
+    def do_GET(self):
+        RangeRequestHandler.served += 1
+        start, end = 0, len(self.content) - 1
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), end)
+        body = self.content[start : end + 1]
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.drop_after is not None:
+            body = body[: self.drop_after]
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class testPartialDownload(unittest.TestCase):
+    """Test utils/partial_download.py"""
+
+    def setUp(self):
+        self.tmp_dirpath = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dirpath, "stream.webm")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/stream"
+        self.chunk_size = config.DOWNLOAD_CHUNK_SIZE
+        config.DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+    def test_resume_after_dropped_connection(self):
+        """Test an interrupted download keeps its progress and resumes"""
+        content = RangeRequestHandler.content
+        RangeRequestHandler.drop_after = 100000
+        with self.assertRaises(Exception):
+            partial_download.download_resumable(self.url, self.path, len(content))
+        state = partial_download.read_sidecar(f"{self.path}.part", len(content))
+        received = state["segments"][0][2]
+        # only bytes flushed to the partial file are recorded
+        self.assertGreater(received, 0)
+        self.assertLessEqual(received, 100000)
+
+        RangeRequestHandler.drop_after = None
+        partial_download.download_resumable(self.url, self.path, len(content))
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), content)
+        self.assertEqual(os.listdir(self.tmp_dirpath), ["stream.webm"])
+
+    def test_segmented_download(self):
+        """Test a large stream is fetched as parallel byte ranges"""
+        content = RangeRequestHandler.content
+        threshold = config.SEGMENT_THRESHOLD
+        config.SEGMENT_THRESHOLD = 1
+        write_sidecar = partial_download.write_sidecar
+        unwritten = []
+
+        def checked_write_sidecar(part_path, state):
+            """Check every byte recorded by any segment is in the file"""
+            with open(part_path, "rb") as file:
+                for start, _, received in state["segments"]:
+                    file.seek(start)
+                    if file.read(received) != content[start : start + received]:
+                        unwritten.append(start)
+            write_sidecar(part_path, state)
+
+        try:
+            state = partial_download.new_state(len(content), segments=3)
+            self.assertEqual(len(state["segments"]), 3)
+            self.assertEqual(state["segments"][-1][1], len(content) - 1)
+            with mock.patch.object(partial_download, "write_sidecar", checked_write_sidecar):
+                partial_download.download_resumable(self.url, self.path, len(content), segments=3)
+        finally:
+            config.SEGMENT_THRESHOLD = threshold
+        self.assertEqual(unwritten, [])
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), content)
+
+    def test_iter_download(self):
+        """Test a stream is read in Range requests, or one request if its size is unknown"""
+        content = RangeRequestHandler.content
+        served = RangeRequestHandler.served
+        self.assertEqual(b"".join(partial_download.iter_download(self.url, len(content))), content)
+        self.assertEqual(RangeRequestHandler.served - served, len(content) // config.DOWNLOAD_CHUNK_SIZE)
+        self.assertEqual(b"".join(partial_download.iter_download(self.url)), content)
+
+    def test_shared_session(self):
+        """Test requests reuse one pooled session"""
+        self.assertIs(http_client.get_session(), http_client.get_session())
+        response = http_client.get(self.url, headers={"Range": "bytes=0-9"})
+        self.assertEqual(response.content, RangeRequestHandler.content[:10])
+
+    def test_incomplete_segments(self):
+        """Test a gap between segments fails verification"""
+        part_path = os.path.join(self.tmp_dirpath, "stream.part")
+        with open(part_path, "wb") as file:
+            file.truncate(100)
+        state = {"filesize": 100, "segments": [[0, 49, 50], [60, 99, 40]]}
+        with self.assertRaises(RuntimeError):
+            partial_download.verify_complete(part_path, state)
+
+    def tearDown(self):
+        RangeRequestHandler.drop_after = None
+        config.DOWNLOAD_CHUNK_SIZE = self.chunk_size
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dirpath, ignore_errors=True)
+
+
+class FakeAudioStream(FakeStream):
+    """Stand-in for a pytube Stream of an audio file served at `url`"""
+
+    def __init__(self, itag, audio_codec, path, url):
+        super().__init__(itag, audio_codec, "128kbps")
+        self.subtype = "mp4"
+        self.path = path
+        self.url = url
+        self.filesize = os.path.getsize(path)
+
+
+class testDownloadPipeline(unittest.TestCase):
+    """Test download_youtube.pipeline_query_youtube"""
+
+    def setUp(self):
+        self.tmp_dirpath = tempfile.mkdtemp()
+        self.download_path = os.path.join(self.tmp_dirpath, "download")
+        self.mp4_path = os.path.join(self.tmp_dirpath, "mp4")
+        os.makedirs(self.mp4_path)
+        os.makedirs(self.download_path)
+        source = os.path.join(self.tmp_dirpath, "source.m4a")
+        command = [transcode.ffmpeg_binary(), "-y", "-loglevel", "error", "-f", "lavfi", "-i", "sine=duration=1"]
+        transcode.run_ffmpeg(command + ["-c:a", "aac", source])
+        with open(source, "rb") as file:
+            handler = type("AudioRequestHandler", (RangeRequestHandler,), {"content": file.read()})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{self.server.server_address[1]}/stream"
+        self.streams = FakeStreamQuery([FakeAudioStream(140, "mp4a.40.2", source, url)])
+        self.cache = media_cache.MediaCache(os.path.join(self.tmp_dirpath, "cache"), config.MEDIA_CACHE_MAX_BYTES)
+        for target, attribute, value in (
+            (download_youtube, "youtube_streams", mock.Mock(return_value=self.streams)),
+            (download_youtube, "get_media_cache", lambda: self.cache),
+            (download_youtube, "get_artwork", lambda url: None),
+        ):
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def args(self, video_id, save_as_mp4):
+        song_properties = {"song": video_id, "album": "Album", "artist": "Artist", "genre": "Rock", "artwork": ""}
+        return ((video_id, {"id": video_id}), (self.download_path, self.mp4_path), song_properties, save_as_mp4)
+
+    def download(self, video_properties, stream_transcode):
+        with mock.patch.object(config, "STREAM_TRANSCODE", stream_transcode):
+            results = download_youtube.pipeline_query_youtube(video_properties)
+        for _, result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def test_stream_transcode(self):
+        """Test streamed downloads write no scratch file and skip the encode stage"""
+        with mock.patch.object(download_youtube, "map_pipeline") as map_pipeline:
+            self.download([self.args("vid1", True), self.args("vid1", False)], stream_transcode=True)
+        map_pipeline.assert_not_called()
+        self.assertEqual(sorted(os.listdir(self.download_path)), ["vid1.m4a", "vid1.mp3"])
+        self.assertEqual(os.listdir(self.mp4_path), [])
+        self.assertGreater(MP3(os.path.join(self.download_path, "vid1.mp3")).info.length, 0.5)
+
+    def test_shared_scratch_file(self):
+        """Test formats of one video fetched at once share one scratch file"""
+        barrier = threading.Barrier(2, timeout=5)
+
+        def youtube_streams(video_id):
+            barrier.wait()  # both jobs fetch at once
+            return self.streams
+
+        download_youtube.youtube_streams.side_effect = youtube_streams
+        served = RangeRequestHandler.served
+        self.download([self.args("vid1", True), self.args("vid1", False)], stream_transcode=False)
+        self.assertEqual(RangeRequestHandler.served - served, 1)
+        self.assertEqual(sorted(os.listdir(self.download_path)), ["vid1.m4a", "vid1.mp3"])
+        self.assertEqual(os.listdir(self.mp4_path), [])
+
+    def test_encode_job(self):
+        """Test song properties and artwork stay out of the encode processes"""
+        sent = []
+
+        def map_pipeline(thread_func, *args, **kwargs):
+            def fetch(item):
+                sent.append(thread_func(item))
+                return sent[-1]
+
+            return _threading.map_pipeline(fetch, *args, **kwargs)
+
+        video_args = self.args("vid1", False)
+        video_args[2]["artwork_bytes"] = b"\xff\xd8\xff" + b"\0" * 16
+        with mock.patch.object(download_youtube, "map_pipeline", map_pipeline):
+            self.download([video_args], stream_transcode=False)
+        self.assertEqual([job["song_properties"] for job in sent], [None])
+        self.assertIn("APIC:Cover", MP3(os.path.join(self.download_path, "vid1.mp3")).tags)
+
+    def test_cached_download(self):
+        """Test a cached video is served without looking up its streams"""
+        for stream_transcode in (False, True):
+            self.download([self.args("vid1", True)], stream_transcode)
+            download_youtube.youtube_streams.reset_mock()
+            os.remove(os.path.join(self.download_path, "vid1.m4a"))
+            self.download([self.args("vid1", True)], stream_transcode)
+            download_youtube.youtube_streams.assert_not_called()
+            self.assertTrue(os.path.isfile(os.path.join(self.download_path, "vid1.m4a")))
+
+    def test_duplicate_download(self):
+        """Test a duplicate download is retagged without the first one's tags"""
+        leader, follower = self.args("vid1", False), self.args("vid1", False)
+        leader[2]["artwork_bytes"] = b"\xff\xd8\xff" + b"\0" * 16
+        follower[2]["song"] = "Other"
+        self.assertEqual(download_youtube.download_key(follower), ("vid1", False))
+        for cache in (self.cache, media_cache.MediaCache(self.cache.directory, 0)):
+            with mock.patch.object(download_youtube, "get_media_cache", lambda: cache):
+                self.download([leader, follower], stream_transcode=False)
+            self.assertIn("APIC:Cover", MP3(os.path.join(self.download_path, "vid1.mp3")).tags)
+            tags = MP3(os.path.join(self.download_path, "Other.mp3")).tags
+            self.assertEqual(str(tags["TIT2"]), "Other")
+            self.assertNotIn("APIC:Cover", tags)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dirpath, ignore_errors=True)
+
+
+class testMediaCache(unittest.TestCase):
+    """Test utils/media_cache.py"""
+
+    def setUp(self):
+        self.tmp_dirpath = tempfile.mkdtemp()
+        self.cache = media_cache.MediaCache(os.path.join(self.tmp_dirpath, "cache"), max_bytes=250)
+
+    def write_audio(self, filename, size):
+        """Write a fake audio file of size bytes"""
+        path = os.path.join(self.tmp_dirpath, filename)
+        with open(path, "wb") as file:
+            file.write(os.urandom(size))
+        return path
+
+    def test_key(self):
+        """Test output format and stream selection are part of the cache key"""
+        key = media_cache.MediaCache.key("nbXACcsTn84", False)
+        self.assertEqual(key, media_cache.MediaCache.key("nbXACcsTn84", False))
+        self.assertNotEqual(key, media_cache.MediaCache.key("nbXACcsTn84", True))
+        self.assertNotEqual(key, media_cache.MediaCache.key("KlmPOxwoC6Y", False))
+        with mock.patch.object(config, "AUDIO_CODEC_PREFERENCE", ("opus", "mp4a")):
+            self.assertNotEqual(key, media_cache.MediaCache.key("nbXACcsTn84", False))
+
+    def test_put_get(self):
+        """Test a cached file is copied, not linked, to the target"""
+        source = self.write_audio("song.mp3", 100)
+        self.cache.put("abc", source)
+        target = os.path.join(self.tmp_dirpath, "copy.mp3")
+        self.assertTrue(self.cache.get("abc", target))
+        self.assertFalse(self.cache.get("def", os.path.join(self.tmp_dirpath, "miss.mp3")))
+        with open(source, "rb") as source_file, open(target, "rb") as target_file:
+            self.assertEqual(source_file.read(), target_file.read())
+        self.assertFalse(os.path.samefile(target, self.cache.entry_path("abc", target)))
+
+    def test_unwritable_cache(self):
+        """Test a cache that can't be written is skipped, not an error"""
+        source = self.write_audio("song.mp3", 100)
+        cache = media_cache.MediaCache(source, max_bytes=250)  # a file, not a folder
+        cache.put("abc", source)
+        self.assertFalse(cache.get("abc", os.path.join(self.tmp_dirpath, "copy.mp3")))
+
+    def test_lru_eviction(self):
+        """Test least recently used entries go first once over the cap"""
+        for key, mtime in (("aaa", 1), ("bbb", 2), ("ccc", 3)):
+            self.cache.put(key, self.write_audio(f"{key}.mp3", 100))
+            os.utime(self.cache.entry_path(key, "song.mp3"), (mtime, mtime))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(self.cache.entry_path("aaa", "song.mp3")))
+        self.assertTrue(os.path.exists(self.cache.entry_path("ccc", "song.mp3")))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dirpath, ignore_errors=True)
+
+
+class testArtworkCache(unittest.TestCase):
+    """Test utils/artwork_cache.py"""
+
+    def setUp(self):
+        self.tmp_dirpath = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/600x600bb.jpg"
+        RangeRequestHandler.served = 0
+
+    def test_single_fetch(self):
+        """Test concurrent requests for one url share a single fetch"""
+        cache = artwork_cache.ArtworkCache(max_bytes=4 * 1024**2)
+        results = list(_threading.map_threads(cache.get, [self.url] * 20))
+        self.assertEqual(RangeRequestHandler.served, 1)
+        self.assertTrue(all(result == RangeRequestHandler.content for result in results))
+
+    def test_disk_backing(self):
+        """Test artwork too large for memory is served from disk"""
+        cache = artwork_cache.ArtworkCache(max_bytes=1024, directory=self.tmp_dirpath)
+        self.assertEqual(cache.get(self.url), RangeRequestHandler.content)
+        self.assertEqual(cache.get(self.url), RangeRequestHandler.content)
+        self.assertEqual(RangeRequestHandler.served, 1)
+        self.assertEqual(cache.memory_bytes, 0)
+
+    def test_unwritable_disk(self):
+        """Test artwork is still served if the disk folder can't be written"""
+        directory = os.path.join(self.tmp_dirpath, "file")
+        open(directory, "wb").close()  # a file, not a folder
+        cache = artwork_cache.ArtworkCache(max_bytes=1024, directory=directory)
+        self.assertEqual(cache.get(self.url), RangeRequestHandler.content)
+
+    def test_not_a_url(self):
+        """Test table placeholders are not fetched"""
+        cache = artwork_cache.ArtworkCache(max_bytes=1024)
+        self.assertIsNone(cache.get("Unknown"))
+        self.assertIsNone(cache.get(""))
+
+    def test_valid_artwork(self):
+        """Test only JPEG artwork is accepted for tagging"""
+        self.assertTrue(artwork_cache.valid_artwork(b"\xff\xd8\xff\xe0JFIF"))
+        self.assertFalse(artwork_cache.valid_artwork(b"\x89PNG"))
+        self.assertFalse(artwork_cache.valid_artwork(None))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dirpath, ignore_errors=True)
+
+
+class testSQLiteCache(unittest.TestCase):
+    """Test utils/sqlite_cache.py"""
+
+    def setUp(self):
+        self.tmp_dirpath = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dirpath, "cache.sqlite3")
+
+    def test_get_put(self):
+        """Test values and missing results are stored"""
+        cache = sqlite_cache.SQLiteCache(self.path, "lookup", ttl=60)
+        self.assertEqual(cache.get("police no time this time"), (False, None))
+        cache.put("police no time this time", {"track_name": "No Time This Time"})
+        cache.put("no such song", None)
+        self.assertEqual(cache.get("police no time this time"), (True, {"track_name": "No Time This Time"}))
+        self.assertEqual(cache.get("no such song"), (True, None))
+
+    def test_ttl(self):
+        """Test missing results expire after the negative TTL"""
+        cache = sqlite_cache.SQLiteCache(self.path, "lookup", ttl=60, negative_ttl=-1)
+        cache.put("found", {"track_name": "Found"})
+        cache.put("not found", None)
+        self.assertTrue(cache.get("found")[0])
+        self.assertFalse(cache.get("not found")[0])
+
+    def test_max_entries(self):
+        """Test oldest entries are evicted past max_entries"""
+        cache = sqlite_cache.SQLiteCache(self.path, "lookup", ttl=60, max_entries=2)
+        for key in ("first", "second", "third"):
+            cache.put(key, key)
+            time.sleep(0.01)
+        self.assertFalse(cache.get("first")[0])
+        self.assertTrue(cache.get("third")[0])
+
+    def test_unwritable_folder(self):
+        """Test a cache whose folder can't be created misses instead of failing"""
+        open(os.path.join(self.tmp_dirpath, "file"), "wb").close()
+        cache = sqlite_cache.SQLiteCache(os.path.join(self.tmp_dirpath, "file", "cache.sqlite3"), "lookup", ttl=60)
+        cache.put("found", {"track_name": "Found"})
+        self.assertEqual(cache.get("found"), (False, None))
+
+    def test_normalize_query(self):
+        """Test searches differing in case and spacing share an entry"""
+        self.assertEqual(
+            query_itunes.normalize_query("  The Police -  No Time This Time"),
+            query_itunes.normalize_query("the police - no time this time"),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dirpath, ignore_errors=True)
+
+
+class testVideoRecords(unittest.TestCase):
+    """Test utils/video_records.py"""
+
+    def setUp(self):
+        self.records = video_records.VideoRecords(
+            [
+                video_records.VideoRecord("a", "Intro", 60),
+                video_records.VideoRecord("b", "Intro", 90, artist="The Police"),
+                video_records.VideoRecord("a", "Intro", 60),
+            ]
+        )
+
+    def test_keyed_by_id(self):
+        """Test videos sharing a title are kept, repeated videos are not"""
+        self.assertEqual([record.id for record in self.records], ["a", "b"])
+        self.assertEqual(self.records[1].duration, 90)
+        self.assertEqual(self.records.index("b"), 1)
+        self.records.remove("a")
+        self.assertEqual(self.records[0].id, "b")
+        self.assertNotIn("a", self.records)
+
+    def test_dict_access(self):
+        """Test records read like the video dicts they replace"""
+        title, record = self.records.items()[1]
+        self.assertEqual((title, record["id"], record.get("artist")), ("Intro", "b", "The Police"))
+        self.assertIsNone(record.get("track"))
+        with self.assertRaises(KeyError):
+            record["album"]
+
+    def test_projection(self):
+        """Test the heavy extractor payload is not kept"""
+        record = video_records.VideoRecord.from_info(
+            {"id": "a", "title": "Intro", "duration": 60, "thumbnails": [{"url": "x"}] * 100, "description": "..."}
+        )
+        self.assertEqual(record.to_dict(), {"id": "a", "title": "Intro", "duration": 60})
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual(record, video_records.VideoRecord("a", "Intro", 60))
+        self.assertEqual(len({record, video_records.VideoRecord("a", "Intro", 60)}), 1)
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """Answer 429 to the first `throttle` requests, then 200."""
+
+    throttle = 0
+    served = 0
+    status = 200
+
+    def do_GET(self):
+        ThrottlingHandler.served += 1
+        self.send_response(429 if ThrottlingHandler.served <= self.throttle else self.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class testRateLimit(unittest.TestCase):
+    """Test utils/rate_limit.py"""
+
+    def setUp(self):
+        ThrottlingHandler.served = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/search"
+
+    def test_token_bucket(self):
+        """Test requests past the burst wait for tokens"""
+        limiter = rate_limit.RateLimiter(rate=50, burst=1, max_concurrency=4)
+        start = time.monotonic()
+        for _ in range(6):
+            with limiter.slot():
+                pass
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_throttle_backoff(self):
+        """Test throttled requests halve concurrency and are retried"""
+        ThrottlingHandler.throttle = 2
+        limiter = rate_limit.RateLimiter(rate=100, burst=10, max_concurrency=8, backoff_base=0.01)
+        response = limiter.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(limiter.stats, {"throttled": 2, "retried": 2, "succeeded": 1})
+        self.assertLess(limiter.concurrency, 8)
+
+    def test_give_up(self):
+        """Test the last throttled response is returned after max_retries"""
+        ThrottlingHandler.throttle = 10
+        limiter = rate_limit.RateLimiter(rate=100, burst=10, max_concurrency=8, max_retries=1, backoff_base=0.01)
+        self.assertEqual(limiter.get(self.url).status_code, 429)
+        self.assertEqual(limiter.stats["gave_up"], 1)
+
+    def test_failures(self):
+        """Test server errors and failed requests are recorded without growing concurrency"""
+        limiter = rate_limit.RateLimiter(rate=100, burst=10, max_concurrency=8)
+        limiter.concurrency = 2.0
+        ThrottlingHandler.status = 503
+        self.assertEqual(limiter.get(self.url).status_code, 503)
+        with self.assertRaises(Exception):
+            limiter.get("http://127.0.0.1:1/search")  # connection refused
+        self.assertEqual(limiter.stats, {"failed": 2})
+        self.assertEqual(limiter.concurrency, 2.0)
+
+    def test_deadline(self):
+        """Test waits for a token or a backoff end with the deadline"""
+        limiter = rate_limit.RateLimiter(rate=0.1, burst=1, max_concurrency=4)
+        limiter.acquire()
+        start = time.monotonic()
+        with timeout.deadline_scope(0.2), self.assertRaises(TimeoutError):
+            limiter.acquire()  # next token in 10s
+        ThrottlingHandler.throttle = 10
+        limiter = rate_limit.RateLimiter(rate=100, burst=10, max_concurrency=8, backoff_base=10)
+        with timeout.deadline_scope(0.2), self.assertRaises(TimeoutError):
+            limiter.get(self.url)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def tearDown(self):
+        ThrottlingHandler.throttle = 0
+        ThrottlingHandler.status = 200
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class testSingleFlight(unittest.TestCase):
+    """Test utils/single_flight.py"""
+
+    def setUp(self):
+        self.flight = single_flight.SingleFlight()
+        self.calls = 0
+        self.release = threading.Event()
+
+    def slow_call(self, value):
+        self.calls += 1
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def run_concurrently(self, value, count=4):
+        outcomes = []
+
+        def call():
+            try:
+                outcomes.append(self.flight.do("key", self.slow_call, value))
+            except Exception as error:
+                outcomes.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while len(self.flight.in_flight) == 0 or self.calls == 0:
+            time.sleep(0.01)
+        time.sleep(0.05)  # let the other callers join the flight
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_shared_result(self):
+        """Test concurrent calls with one key run once and share the result"""
+        outcomes = self.run_concurrently("result")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(outcomes), [("result", False)] + [("result", True)] * 3)
+        self.assertEqual(self.flight.in_flight, {})
+
+    def test_shared_exception(self):
+        """Test every waiter gets the exception of a failed call"""
+        outcomes = self.run_concurrently(LookupError("no match"))
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(isinstance(outcome, LookupError) for outcome in outcomes))
+
+class testTimeout(unittest.TestCase):
+    """Test utils/timeout.py"""
+
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()  # let abandoned calls finish
+
+    def hang(self):
+        self.release.wait(10)
+        return "late"
+
+    def test_deadline(self):
+        """Test remaining time and clamping of per-call timeouts"""
+        unlimited = timeout.Deadline()
+        self.assertIsNone(unlimited.remaining())
+        self.assertEqual(unlimited.clamp((3.05, 10)), (3.05, 10))
+        deadline = timeout.Deadline(5)
+        self.assertLessEqual(deadline.clamp(30), 5)
+        self.assertEqual(deadline.clamp(1), 1)
+        self.assertEqual(deadline.clamp((3.05, 10))[0], 3.05)
+        self.assertLessEqual(deadline.clamp((3.05, 10))[1], 5)
+        expired = timeout.Deadline(0)
+        self.assertTrue(expired.expired())
+        with self.assertRaises(TimeoutError):
+            expired.clamp(10)
+
+    def test_deadline_scope(self):
+        """Test nested scopes keep the earlier deadline"""
+        self.assertIsNone(timeout.current_deadline().remaining())
+        with timeout.deadline_scope(5) as outer:
+            with timeout.deadline_scope(60):
+                self.assertIs(timeout.current_deadline(), outer)
+            with timeout.deadline_scope(1):
+                self.assertLessEqual(timeout.current_deadline().remaining(), 1)
+            with timeout.deadline_scope(None):
+                self.assertIs(timeout.current_deadline(), outer)
+        self.assertIsNone(timeout.current_deadline().remaining())
+
+    def test_call_with_timeout(self):
+        """Test a hung call is abandoned, results and errors pass through"""
+        self.assertEqual(timeout.call_with_timeout(lambda value: value + 1, 1, 1), 2)
+        with self.assertRaises(KeyError):
+            timeout.call_with_timeout({}.__getitem__, 1, "missing")
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            timeout.call_with_timeout(self.hang, 0.2)
+        self.assertLess(time.monotonic() - start, 2)
+        with timeout.deadline_scope(0.2), self.assertRaises(TimeoutError):
+            timeout.call_with_timeout(self.hang, 30)  # cut short by the deadline
+
+    def test_timeout_off_main_thread(self):
+        """Test the timeout decorator works on pool worker threads"""
+        hang = timeout.timeout(0.2, "took too long")(self.hang)
+
+        def call(_):
+            try:
+                return hang()
+            except TimeoutError as error:
+                return str(error)
+
+        self.assertEqual(_threading.map_threads(call, range(4)), ["took too long"] * 4)
+
+    def test_iter_with_deadline(self):
+        """Test each step of a generator runs under the deadline, the caller doesn't"""
+        deadline = timeout.Deadline(5)
+        seen = []
+        for remaining in timeout.iter_with_deadline((timeout.current_deadline() for _ in range(3)), deadline):
+            seen.append(remaining)
+            self.assertIsNone(timeout.current_deadline().remaining())
+        self.assertEqual(seen, [deadline] * 3)
+        with timeout.deadline_scope(deadline):
+            self.assertIs(timeout.current_deadline(), deadline)
+
+    def test_deadline_propagates(self):
+        """Test pool workers run under the caller's deadline"""
+        with timeout.deadline_scope(5) as deadline:
+            seen = _threading.map_threads(lambda _: timeout.current_deadline(), range(4))
+            seen += [result for _, result in _threading.imap_threads(lambda _: timeout.current_deadline(), range(4))]
+        self.assertTrue(all(result is deadline for result in seen))
+
+    def test_http_deadline(self):
+        """Test HTTP requests are not sent once the deadline expired"""
+        with mock.patch.object(http_client, "get_session") as get_session:
+            with timeout.deadline_scope(0), self.assertRaises(TimeoutError):
+                http_client.get("http://localhost/")
+            get_session.assert_not_called()
+            with timeout.deadline_scope(5):
+                http_client.get("http://localhost/")
+            _, kwargs = get_session.return_value.get.call_args
+            self.assertEqual(kwargs["timeout"][0], config.HTTP_TIMEOUT[0])
+            self.assertLessEqual(kwargs["timeout"][1], 5)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
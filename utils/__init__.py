@@ -1,6 +1,14 @@
-"""Allow access to four methods from utils"""
+"""Allow access to methods from utils"""
 
 from utils._threading import map_threads
+from utils.annotate import annotate_itunes
+from utils.artwork_cache import get_artwork
 from utils.query_itunes import thread_query_itunes
-from utils.query_youtube import get_youtube_content
-from utils.download_youtube import thread_query_youtube
+from utils.query_youtube import (
+    get_youtube_content,
+    is_permanent_error,
+    iter_youtube_content,
+    iter_youtube_content_retrying,
+)
+from utils.download_youtube import pipeline_query_youtube, thread_query_youtube
+from utils.video_records import VideoRecord, VideoRecords
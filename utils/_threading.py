@@ -1,15 +1,173 @@
+import atexit
 import concurrent.futures
+import itertools
+import os
+import queue
+import sys
+import threading
 
+from utils import config
+from utils.timeout import current_deadline, in_context
 
-def map_threads(func, _iterable):
+# named long-lived pools: executor class and the config setting of its size
+POOLS = {
+    "metadata": (concurrent.futures.ThreadPoolExecutor, "METADATA_WORKERS"),
+    "network": (concurrent.futures.ThreadPoolExecutor, "NETWORK_WORKERS"),
+    "encode": (concurrent.futures.ProcessPoolExecutor, "ENCODE_WORKERS"),
+}
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, broken=None):
+    """Get the long-lived executor of a named pool (see POOLS), created on
+    first use and shut down at exit -- or replaced, if it is `broken`. Never
+    wait on a pool's futures from its own workers: once every worker
+    waits, nothing is left to run them."""
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None or executor is broken:
+            if not _executors:
+                atexit.register(shutdown_executors)
+            executor_class, _ = POOLS[name]
+            executor = _executors[name] = executor_class(pool_workers(name))
+    return executor
+
+
+def submit(pool, func, *args):
+    """Submit func(*args) to a named pool. A process pool is broken for
+    good once a worker dies -- it is then replaced and func resubmitted."""
+    executor = get_executor(pool)
+    try:
+        return executor.submit(func, *args)
+    except concurrent.futures.BrokenExecutor:
+        return get_executor(pool, broken=executor).submit(func, *args)
+
+
+def pool_workers(name):
+    """Get the configured worker count of a named pool."""
+    executor_class, setting = POOLS[name]
+    workers = getattr(config, setting)
+    if workers:
+        return workers
+    if executor_class is concurrent.futures.ProcessPoolExecutor:
+        return os.cpu_count()
+    return min(32, (os.cpu_count() or 1) + 4)  # ThreadPoolExecutor default
+
+
+def shutdown_executors(wait=True):
+    """Shut down every pool, dropping work not started yet -- on Python
+    3.8, which can't cancel it, that work still runs first."""
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+        atexit.unregister(shutdown_executors)
+    for executor in executors:
+        if sys.version_info >= (3, 9):
+            executor.shutdown(wait=wait, cancel_futures=True)
+        else:
+            executor.shutdown(wait=wait)
+
+
+def map_threads(func, _iterable, pool="metadata"):
     """Map function with iterable object in using thread pools."""
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        result = executor.map(func, _iterable)
-    return result
+    futures = [submit(pool, in_context(func), item) for item in _iterable]
+    return [future.result() for future in futures]
+
+
+def imap_threads(func, _iterable, pool="metadata", callback=None, max_pending=None):
+    """Map function with iterable object in a thread pool, yielding
+    (index, result) in order of completion -- result is the exception if
+    func raised. `callback(index, result)` is called as each item finishes.
+    At most `max_pending` items (default twice the pool size) are submitted
+    at once, so large generators are consumed as results come in. Items
+    run under the caller's deadline (see utils.timeout)."""
+    max_pending = max_pending or 2 * pool_workers(pool)
+    items = enumerate(_iterable)
+    pending = {}
+    while True:
+        for index, item in itertools.islice(items, max_pending - len(pending)):
+            pending[submit(pool, in_context(func), item)] = index
+        if not pending:
+            return
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            error = future.exception()
+            result = error if error is not None else future.result()
+            if callback:
+                callback(index, result)
+            yield index, result
 
 
-def map_processes(func, _iterable):
+def map_processes(func, _iterable, pool="encode"):
     """Map function with iterable object in using process pools."""
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        result = executor.map(func, _iterable)
-    return result
+    futures = [submit(pool, func, item) for item in _iterable]
+    return [future.result() for future in futures]
+
+
+def map_pipeline(
+    thread_func,
+    process_func,
+    _iterable,
+    finish_func=None,
+    thread_pool="network",
+    process_pool="encode",
+    queue_size=None,
+    callback=None,
+):
+    """Map iterable object through two pools: `thread_func` in a thread pool
+    (I/O bound stage), then `process_func` in a process pool (CPU bound stage).
+    Thread results wait in a bounded queue, so thread workers block while the
+    process pool is behind. `finish_func`, if given, runs on each process
+    result back in this process. `callback(item, result)` is called as each
+    item finishes. Return a list of (item, result) in order of completion --
+    result is the exception instead if any stage failed. Items still queued
+    once the caller's deadline expired fail with TimeoutError; the deadline
+    doesn't reach into the process pool, pass it in the item to bound that."""
+    process_workers = pool_workers(process_pool)
+    handoff = queue.Queue(maxsize=queue_size or process_workers)
+    results = []  # list.append is thread safe
+
+    def finish(item, result):
+        results.append((item, result))
+        if callback:
+            callback(item, result)
+
+    def produce(item):
+        try:
+            handoff.put((item, thread_func(item)))
+        except Exception as error:
+            finish(item, error)
+
+    def consume():
+        # one consumer per process worker: at most `process_workers` items
+        # leave the queue at once, the rest stay in the queue
+        while True:
+            entry = handoff.get()
+            if entry is None:
+                return
+            item, value = entry
+            try:
+                current_deadline().check()
+                value = submit(process_pool, process_func, value).result()
+                if finish_func:
+                    value = finish_func(value)
+                finish(item, value)
+            except Exception as error:
+                finish(item, error)
+
+    consumers = [threading.Thread(target=in_context(consume)) for _ in range(process_workers)]
+    for consumer in consumers:
+        consumer.start()
+    try:
+        # items are read as thread workers free up, not all up front
+        for _ in imap_threads(produce, _iterable, pool=thread_pool):
+            pass
+    finally:
+        for _ in consumers:
+            handoff.put(None)
+        for consumer in consumers:
+            consumer.join()
+    return results
@@ -0,0 +1,57 @@
+import asyncio
+
+from utils import config
+from utils._threading import get_executor
+from utils.query_itunes import thread_query_itunes
+from utils.timeout import Deadline, call_with_timeout, deadline_scope, in_context
+
+
+async def annotate_itunes_async(rows, concurrency=None, deadline=None):
+    """Look up iTunes metadata of every (row_index, (title, video)) row at
+    once, at most `concurrency` at a time. Yield (row_index, ITUNES_META_JSON)
+    in order of completion -- ITUNES_META_JSON is None if the lookup failed,
+    took over config.ANNOTATE_TIMEOUT seconds, or didn't finish within
+    `deadline` seconds (default config.ANNOTATE_DEADLINE) of the batch."""
+    concurrency = concurrency or config.ANNOTATE_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    batch = Deadline(deadline or config.ANNOTATE_DEADLINE)
+
+    async def annotate(executor, row):
+        async with semaphore:
+            try:
+                # each task has its own context: the scope is the task's only
+                with deadline_scope(batch):
+                    # oEmbed, search and artwork requests are blocking -- run them off the
+                    # loop, and give up on a hung one so its worker is free for the next row
+                    return await loop.run_in_executor(
+                        executor, in_context(call_with_timeout), thread_query_itunes, config.ANNOTATE_TIMEOUT, row
+                    )
+            except Exception as error:
+                print(f"Error: {str(error)}")  # poor man's logging
+                return (row[0], None)
+
+    executor = get_executor("metadata")
+    tasks = [asyncio.ensure_future(annotate(executor, row)) for row in rows]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def annotate_itunes(rows, concurrency=None, callback=None, deadline=None):
+    """Blocking wrapper of annotate_itunes_async for threads without an
+    event loop (QThread, Streamlit). `callback(row_index, ITUNES_META_JSON)`
+    is called as each lookup finishes. Return tuple of all results."""
+
+    async def collect():
+        results = []
+        async for row_index, itunes_meta_json in annotate_itunes_async(rows, concurrency, deadline):
+            if callback:
+                callback(row_index, itunes_meta_json)
+            results.append((row_index, itunes_meta_json))
+        return tuple(results)
+
+    return asyncio.run(collect())
@@ -0,0 +1,134 @@
+import collections
+import contextlib
+import hashlib
+import os
+import threading
+
+import requests
+
+from utils import config, http_client
+from utils.media_cache import evict_lru
+from utils.single_flight import SingleFlight
+
+
+class ArtworkCache:
+    """Thread-safe store of artwork bytes by url: least recently used
+    entries are dropped from memory past `max_bytes`, and kept on disk in
+    `directory` if given. Concurrent requests for a url share one fetch."""
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.flight = SingleFlight()
+
+    def get(self, url):
+        """Get artwork bytes of url, None if it is not a url or the
+        request failed."""
+        if not url or not url.startswith(("http://", "https://")):
+            return None
+        with self.lock:
+            if url in self.memory:
+                self.memory.move_to_end(url)
+                return self.memory[url]
+        artwork, _ = self.flight.do(url, self.load, url)
+        return artwork
+
+    def load(self, url):
+        """Read artwork bytes of url from disk, else fetch and store them."""
+        with self.lock:
+            if url in self.memory:  # remembered by a fetch that just finished
+                return self.memory[url]
+        artwork = self.read_disk(url)
+        if artwork is None:
+            artwork = fetch_artwork(url)
+            if artwork is not None:
+                self.write_disk(url, artwork)
+        if artwork is not None:
+            with self.lock:
+                self.remember(url, artwork)
+        return artwork
+
+    def remember(self, url, artwork):
+        """Keep artwork in memory, dropping least recently used entries
+        to stay within max_bytes. Call with self.lock held."""
+        if len(artwork) > self.max_bytes:
+            return
+        self.memory[url] = artwork
+        self.memory_bytes += len(artwork)
+        while self.memory_bytes > self.max_bytes:
+            _, dropped = self.memory.popitem(last=False)
+            self.memory_bytes -= len(dropped)
+
+    def read_disk(self, url):
+        """Get artwork bytes of url stored on disk, if any."""
+        if not self.directory:
+            return None
+        try:
+            with open(self.disk_path(url), "rb") as file:
+                artwork = file.read()
+            os.utime(self.disk_path(url))  # mark as recently used
+            return artwork
+        except OSError:  # missing, or the folder is unreadable
+            return None
+
+    def write_disk(self, url, artwork):
+        """Store artwork bytes of url on disk, if disk backed. Skipped if
+        the folder can't be written, e.g. the disk is full."""
+        if not self.directory:
+            return
+        temp_path = f"{self.disk_path(url)}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "wb") as file:
+                file.write(artwork)
+            os.replace(temp_path, self.disk_path(url))
+            if self.max_disk_bytes:
+                evict_lru(self.directory, self.max_disk_bytes)
+        except OSError as error:
+            print(f"Error: artwork not cached: {str(error)}")  # poor man's logging
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+
+    def disk_path(self, url):
+        """Get path of the disk copy of artwork at url."""
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+
+
+def fetch_artwork(url):
+    """Download artwork bytes, None if the request failed."""
+    try:
+        response = http_client.get(url)
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code != 200:  # invalid image url
+        return None
+    return response.content
+
+
+def valid_artwork(artwork):
+    """Check artwork bytes start with a JPEG header -- the only image format
+    written to tags. Source: https://www.file-recovery.com/jpg-signature-format.htm."""
+    return artwork is not None and artwork[:3] == b"\xff\xd8\xff"
+
+
+_artwork_cache = None
+_artwork_cache_lock = threading.Lock()
+
+
+def get_artwork_cache():
+    """Get the process-wide artwork cache."""
+    global _artwork_cache
+    with _artwork_cache_lock:
+        if _artwork_cache is None:
+            directory = os.path.join(config.CACHE_DIR, "artwork") if config.ARTWORK_CACHE_DISK_BYTES else None
+            _artwork_cache = ArtworkCache(config.ARTWORK_CACHE_MAX_BYTES, directory, config.ARTWORK_CACHE_DISK_BYTES)
+    return _artwork_cache
+
+
+def get_artwork(url):
+    """Get artwork bytes of url through the process-wide artwork cache."""
+    return get_artwork_cache().get(url)
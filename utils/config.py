@@ -0,0 +1,79 @@
+"""Application-wide settings for utils -- change as necessary."""
+
+import os
+
+# Audio-only stream selection. Codecs are matched against the start of the
+# stream's audio codec (e.g. "mp4a.40.2", "opus") in order of preference.
+AUDIO_CODEC_PREFERENCE = ("mp4a", "opus")
+# Highest average bitrate (kbps) to pick, None to always pick the best.
+AUDIO_MAX_BITRATE = None
+# Download the highest resolution video stream if a video has no
+# audio-only stream. Off by default -- it is many times larger.
+VIDEO_FALLBACK = False
+# FFmpeg options for MP3 output -- LAME VBR quality 2 (~190 kbps).
+MP3_ENCODER_ARGS = ("-c:a", "libmp3lame", "-q:a", "2")
+# Pipe downloaded bytes straight into FFmpeg on the network threads rather
+# than writing the stream to the temporary mp4 folder and encoding it on the
+# encode pool. Streamed downloads can't be resumed once interrupted nor
+# fetched in segments, so this is off by default.
+STREAM_TRANSCODE = False
+# Workers of the long-lived "metadata" (YouTube and iTunes lookups),
+# "network" (audio stream downloads) and "encode" (FFmpeg, processes)
+# pools -- None for the executor default, i.e. one process per CPU. Also
+# how many downloaded streams may wait for an encoder before downloads pause.
+METADATA_WORKERS = 16
+NETWORK_WORKERS = 8
+ENCODE_WORKERS = None
+ENCODE_QUEUE_SIZE = 16
+# Bytes per Range request when downloading streams -- YouTube throttles
+# requests for much larger ranges.
+DOWNLOAD_CHUNK_SIZE = 9 * 1024 * 1024
+# Streams of at least SEGMENT_THRESHOLD bytes (long mixes, full albums) are
+# downloaded as DOWNLOAD_SEGMENTS byte ranges over parallel connections.
+DOWNLOAD_SEGMENTS = 4
+SEGMENT_THRESHOLD = 64 * 1024 * 1024
+# Folder for persistent caches.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "youtube2audio")
+# Size cap of the encoded audio cache -- 0 turns the cache off.
+MEDIA_CACHE_MAX_BYTES = 2 * 1024**3
+# Artwork kept in memory, and on disk (0 for memory only).
+ARTWORK_CACHE_MAX_BYTES = 32 * 1024**2
+ARTWORK_CACHE_DISK_BYTES = 128 * 1024**2
+# Shared HTTP session: hosts with a kept-alive connection pool, connections
+# per host (at least the busiest stage's worker count), and the (connect,
+# read) timeout in seconds of every request.
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_SIZE = 32
+HTTP_TIMEOUT = (3.05, 10)
+# iTunes lookups running at once while annotating a playlist.
+ANNOTATE_CONCURRENCY = 16
+# iTunes lookup cache: seconds a match is reused, seconds a search without
+# match is, and the most searches kept.
+ITUNES_CACHE_TTL = 30 * 24 * 3600
+ITUNES_CACHE_NEGATIVE_TTL = 24 * 3600
+ITUNES_CACHE_MAX_ENTRIES = 50000
+# iTunes Search API requests per second, and burst allowed above that.
+ITUNES_RATE_LIMIT = 5.0
+ITUNES_RATE_BURST = 10
+# Retries of a throttled (403/429) request, with jittered exponential
+# backoff starting at BACKOFF_BASE seconds and capped at BACKOFF_CAP.
+ITUNES_MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+# Video metadata cache: seconds a video's metadata or a playlist's
+# membership is kept, and the most videos and playlists kept.
+VIDEO_CACHE_TTL = 7 * 24 * 3600
+VIDEO_CACHE_MAX_ENTRIES = 50000
+PLAYLIST_CACHE_MAX_ENTRIES = 500
+# Attempts at loading a url, or a video of it, after a failure, and the
+# seconds after which a url load stops retrying.
+URL_LOAD_RETRIES = 5
+URL_LOAD_DEADLINE = 120
+# Seconds before a stalled YouTube stream lookup, iTunes lookup or FFmpeg
+# encode is abandoned, and before a whole download or annotation batch
+# gives up on what is left (None for no limit).
+EXTRACT_TIMEOUT = 60
+ANNOTATE_TIMEOUT = 30
+ENCODE_TIMEOUT = 30 * 60
+DOWNLOAD_DEADLINE = None
+ANNOTATE_DEADLINE = None
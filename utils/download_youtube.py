@@ -1,95 +1,351 @@
+import collections
+import contextlib
 import os
-from shutil import copy2
+import threading
 
 from pytubefix import YouTube
-import requests
 from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4, MP4Cover
 from mutagen.id3 import ID3, APIC, TALB, TPE1, TIT2, TCON
-from moviepy.editor import VideoFileClip
+
+from utils import config
+from utils._threading import imap_threads, map_pipeline
+from utils.artwork_cache import get_artwork, valid_artwork
+from utils.media_cache import MediaCache, clone_file, get_media_cache
+from utils.partial_download import download_resumable, iter_download
+from utils.single_flight import SingleFlight
+from utils.timeout import call_with_timeout, current_deadline, deadline_scope
+from utils.transcode import stream_transcode, transcode_audio
+
+
+YT_LINK_STARTER = "https://www.youtube.com/watch?v="
+
+_downloads = SingleFlight()
+_fetches = SingleFlight()
+# jobs using each scratch file -- it is removed once the last one is done
+_scratch_users = collections.Counter()
+_scratch_lock = threading.Lock()
 
 
 def thread_query_youtube(args):
-    """Download video to mp4 then mp3 -- triggered
+    """Download video audio to M4A or MP3 -- triggered
     by map_threads"""
+    try:
+        # the same video and format requested at once is downloaded once
+        job, shared = _downloads.do(download_key(args), download_audio, args)
+        if shared:
+            job = finish_audio(follow_job(job, args))
+        return job
+    except Exception as error:  # not a good Exceptions catch...
+        print(f"Error: {str(error)}")  # poor man's logging
+        raise RuntimeError from error
+
+
+def download_audio(args):
+    """Download, encode and tag the audio of a video."""
+    if config.STREAM_TRANSCODE:
+        return finish_audio(stream_audio(args))
+    job = fetch_audio(args)
+    try:
+        return finish_audio(encode_audio(job))
+    except BaseException:
+        if job["source_path"]:
+            release_scratch(job["source_path"], keep=True)
+        raise
+
+
+def pipeline_query_youtube(video_properties, callback=None, deadline=None):
+    """Download many videos in two stages: audio streams are downloaded by
+    network threads and encoded by a process pool -- or, with
+    config.STREAM_TRANSCODE, piped into FFmpeg as they download on the
+    network threads, skipping the encode stage. Return a list of
+    (args, result) where result is the exception for failed videos, and
+    call `callback(args, result)` as each video finishes. Videos requested
+    more than once in the same format are downloaded once; the other
+    requests get a retagged copy. Videos not done within `deadline` seconds
+    (default config.DOWNLOAD_DEADLINE) fail with TimeoutError."""
+    leaders = {}
+    followers = []
+    for args in video_properties:
+        key = download_key(args)
+        if key in leaders:
+            followers.append(args)
+        else:
+            leaders[key] = args
+
+    with deadline_scope(deadline or config.DOWNLOAD_DEADLINE):
+        if config.STREAM_TRANSCODE:
+            leader_args = list(leaders.values())
+            results = []
+            for index, result in imap_threads(download_audio, leader_args, pool="network"):
+                results.append((leader_args[index], result))
+                if callback:
+                    callback(leader_args[index], result)
+        else:
+            fetched = {}  # jobs by cache key, kept in this process for finish_audio
+
+            def fetch(args):
+                job = fetched[job_key(args)] = fetch_audio(args)
+                # the encode pool needs no song properties -- don't pickle the artwork
+                return dict(job, song_properties=None)
+
+            def finish(job):
+                return finish_audio(fetched[job["cache_key"]])
+
+            results = map_pipeline(
+                fetch,
+                encode_audio,
+                leaders.values(),
+                finish_func=finish,
+                queue_size=config.ENCODE_QUEUE_SIZE,
+                callback=callback,
+            )
+            for args, result in results:
+                job = fetched.get(job_key(args))
+                if isinstance(result, Exception) and job and job["source_path"]:
+                    # not finished -- keep its download for the next attempt
+                    release_scratch(job["source_path"], keep=True)
+        finished = {download_key(args): result for args, result in results}
+        for args in followers:
+            result = finished[download_key(args)]
+            if not isinstance(result, Exception):
+                try:
+                    result = finish_audio(follow_job(result, args))
+                except Exception as error:
+                    result = error
+            results.append((args, result))
+            if callback:
+                callback(args, result)
 
-    yt_link_starter = "https://www.youtube.com/watch?v="
+    for _, result in results:
+        if isinstance(result, Exception):
+            print(f"Error: {str(result)}")  # poor man's logging
+    return results
+
+
+def download_key(args):
+    """Get the key of the audio file args produce before tagging: video
+    id and output format."""
     _, videos_dict = args[0]
-    download_path, mp4_path = args[1]
+    return (videos_dict["id"], args[3])
+
+
+def job_key(args):
+    """Get the cache key of the audio job of args."""
+    return MediaCache.key(*download_key(args))
+
+
+def audio_filename(song_properties, save_as_mp4):
+    extension = "m4a" if save_as_mp4 else "mp3"
+    return f'{song_properties.get("song")}.{extension}'
+
+
+def audio_job(args):
+    """Describe the encode and tag steps for a video's audio -- its codec
+    is only known once the stream is picked. The current deadline goes
+    along: contextvars don't reach the encode processes."""
+    download_path = args[1][0]
     song_properties = args[2]
     save_as_mp4 = args[3]
-    full_link = yt_link_starter + videos_dict["id"]
+    return {
+        "source_path": None,
+        "download_path": download_path,
+        "filename": audio_filename(song_properties, save_as_mp4),
+        "song_properties": song_properties,
+        "save_as_mp4": save_as_mp4,
+        "audio_codec": None,
+        "cache_key": job_key(args),
+        "cached": False,
+        "deadline": current_deadline(),
+    }
 
-    def new_get_youtube_mp3():
-        try:
-            yt = YouTube(full_link)
-            print(yt.title)
 
-            ys = yt.streams.get_audio_only()
-            ys.download(mp3=True)
-        except Exception as error:  # not a good Exceptions catch...
-            print(f"Error: {str(error)}")  # poor man's logging
-            raise RuntimeError from error
+def audio_job_from_cache(args):
+    """Get the audio job of a video, with the audio file already written
+    to the download folder if it was encoded before."""
+    job = audio_job(args)
+    job["cached"] = get_media_cache().get(job["cache_key"], os.path.join(job["download_path"], job["filename"]))
+    return job
 
-    def get_youtube_mp4():
-        """Write MP4 audio file from YouTube video."""
-        try:
-            video = YouTube(full_link)
-            stream = video.streams.get_highest_resolution()
-            mp4_filename = f'{song_properties.get("song")}'
-            illegal_char = (
-                "?",
-                "'",
-                '"',
-                ".",
-                "/",
-                "\\",
-                "*",
-                "^",
-                "%",
-                "$",
-                "#",
-                "~",
-                "<",
-                ">",
-                ",",
-                ";",
-                ":",
-                "|",
-            )
-            # remove illegal characters from song title - otherwise clipped by pytube
-            for char in illegal_char:
-                mp4_filename = mp4_filename.replace(char, "")
-
-            mp4_filename += ".mp4"  # add extension for downstream file recognition
-            stream.download(mp4_path, filename=f"{mp4_filename}")
-            if save_as_mp4:
-                m4a_filename = f'{song_properties.get("song")}.m4a'
-                # Copy song from temporary folder to destination
-                copy2(
-                    os.path.join(mp4_path, mp4_filename),
-                    os.path.join(download_path, m4a_filename),
-                )
-                return set_song_metadata(download_path, song_properties, m4a_filename, True)
 
-            return get_youtube_mp3(mp4_filename)
-        except Exception as error:  # not a good Exceptions catch...
-            print(f"Error: {str(error)}")  # poor man's logging
-            raise RuntimeError from error
+def follow_job(job, args):
+    """Get the audio job of args from the finished job of the same video and
+    format: its untagged audio file is copied, to be tagged with args'
+    properties."""
+    song_properties = args[2]
+    follower = dict(
+        job,
+        source_path=None,
+        download_path=args[1][0],
+        filename=audio_filename(song_properties, args[3]),
+        song_properties=song_properties,
+        cached=True,  # i.e. already encoded
+    )
+    source = os.path.join(job["download_path"], job["filename"])
+    target = os.path.join(follower["download_path"], follower["filename"])
+    if not get_media_cache().get(job["cache_key"], target):
+        # the leader's file is tagged already -- drop its tags, e.g. a
+        # cover the follower has none of, before the follower's are set
+        if source != target:
+            clone_file(source, target)
+        strip_tags(target, follower["save_as_mp4"])
+    return follower
+
 
-    def get_youtube_mp3(mp4_filename):
-        """Write MP3 audio file from MP4."""
-        mp3_filename = f'{song_properties.get("song")}.mp3'
+def strip_tags(path, save_as_mp4):
+    """Remove every tag of an audio file."""
+    audio = MP4(path) if save_as_mp4 else MP3(path, ID3=ID3)
+    if audio.tags is not None:
+        audio.tags.clear()
+        audio.save()
+
+
+def youtube_streams(video_id):
+    """Get the streams of a video from pytube, abandoning the lookup after
+    config.EXTRACT_TIMEOUT seconds -- pytube has no timeout of its own."""
+    return call_with_timeout(lambda: YouTube(YT_LINK_STARTER + video_id).streams, config.EXTRACT_TIMEOUT)
+
+
+def stream_audio(args):
+    """Write M4A or MP3 audio file while the stream downloads."""
+    _, videos_dict = args[0]
+    job = audio_job_from_cache(args)
+    if job["cached"]:
+        return job
+
+    stream = select_audio_stream(youtube_streams(videos_dict["id"]))
+    job["audio_codec"] = stream.audio_codec
+    stream_transcode(
+        iter_download(stream.url, stream.filesize),
+        os.path.join(job["download_path"], job["filename"]),
+        job["save_as_mp4"],
+        job["audio_codec"],
+    )
+    return job
+
+
+def fetch_audio(args):
+    """Download the audio stream of a video to the temporary mp4 folder
+    -- network stage of pipeline_query_youtube."""
+    _, videos_dict = args[0]
+    mp4_path = args[1][1]
+    job = audio_job_from_cache(args)
+    if job["cached"]:
+        return job
+
+    stream = select_audio_stream(youtube_streams(videos_dict["id"]))
+    job["audio_codec"] = stream.audio_codec
+    # name by video id and itag: song titles may repeat or hold illegal characters
+    source_path = os.path.join(mp4_path, f'{videos_dict["id"]}.{stream.itag}.{stream.subtype}')
+    claim_scratch(source_path)
+    try:
+        # jobs of the same stream in other formats wait for one download
+        _fetches.do(source_path, download_stream, stream, source_path)
+    except BaseException:
+        release_scratch(source_path, keep=True)
+        raise
+    job["source_path"] = source_path
+    return job
+
+
+def download_stream(stream, source_path):
+    """Download a stream to its scratch file, unless it is there already."""
+    if stream.filesize:
+        # keeps a partial file on failure, resumed on the next attempt
+        return download_resumable(stream.url, source_path, stream.filesize)
+    if os.path.isfile(source_path):
+        return source_path
+    # size unknown -- download in one request, renamed once complete so a
+    # partial file is never taken for the stream
+    with open(f"{source_path}.part", "wb") as file:
+        for chunk in iter_download(stream.url):
+            file.write(chunk)
+    os.replace(f"{source_path}.part", source_path)
+    return source_path
+
+
+def claim_scratch(source_path):
+    """Mark a scratch file as used by one more job."""
+    with _scratch_lock:
+        _scratch_users[source_path] += 1
+
+
+def release_scratch(source_path, keep=False):
+    """Mark a job done with a scratch file, removing it once no job uses
+    it -- unless `keep`, e.g. to resume a failed download."""
+    with _scratch_lock:
+        _scratch_users[source_path] -= 1
+        if _scratch_users[source_path] > 0:
+            return
+        del _scratch_users[source_path]
+        if not keep:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(source_path)
+
+
+def encode_audio(job):
+    """Remux (M4A) or encode (MP3) a downloaded audio stream into the
+    download folder -- encode stage of pipeline_query_youtube."""
+    if job["cached"]:
+        return job
+    transcode_audio(
+        job["source_path"],
+        os.path.join(job["download_path"], job["filename"]),
+        job["save_as_mp4"],
+        job["audio_codec"],
+        job["deadline"].clamp(config.ENCODE_TIMEOUT),
+    )
+    return job
+
+
+def finish_audio(job):
+    """Cache and tag the written audio file and drop its temporary download."""
+    if not job["cached"]:
+        # cache before tagging: the entry is shared by any song properties
+        get_media_cache().put(job["cache_key"], os.path.join(job["download_path"], job["filename"]))
+    set_song_metadata(job["download_path"], job["song_properties"], job["filename"], job["save_as_mp4"])
+    if job["source_path"]:
+        release_scratch(job["source_path"])
+    return job
+
+
+def select_audio_stream(streams, codec_preference=None, max_bitrate=None, video_fallback=None):
+    """Select the best audio-only stream from a pytube StreamQuery.
+    Streams are ranked by position of their codec in `codec_preference`,
+    then by average bitrate up to `max_bitrate` (kbps). The highest
+    resolution video stream is only returned if `video_fallback` is set."""
+    codec_preference = codec_preference or config.AUDIO_CODEC_PREFERENCE
+    max_bitrate = max_bitrate if max_bitrate is not None else config.AUDIO_MAX_BITRATE
+    video_fallback = video_fallback if video_fallback is not None else config.VIDEO_FALLBACK
+
+    def codec_rank(stream):
+        codec = stream.audio_codec or ""
+        for rank, preferred in enumerate(codec_preference):
+            if codec.startswith(preferred):
+                return rank
+        return len(codec_preference)
+
+    def bitrate(stream):
+        # abr is a str such as "128kbps" -- fall back to the raw bitrate in bps
         try:
-            video = VideoFileClip(os.path.join(mp4_path, mp4_filename))
-            video.audio.write_audiofile(os.path.join(download_path, mp3_filename))
-            set_song_metadata(download_path, song_properties, mp3_filename, False)
-        except Exception as e:
-            print(e)
-        finally:
-            video.close()
+            return int(stream.abr.rstrip("kbps"))
+        except (AttributeError, ValueError):
+            return (stream.bitrate or 0) // 1000
 
-    return get_youtube_mp4()
+    candidates = [stream for stream in streams.filter(only_audio=True) if stream.audio_codec]
+    # skip dubbed tracks in favour of the original audio, if any are marked
+    default_tracks = [stream for stream in candidates if stream.is_default_audio_track]
+    candidates = default_tracks or candidates
+    if max_bitrate:
+        capped = [stream for stream in candidates if bitrate(stream) <= max_bitrate]
+        # if every stream is above the cap, settle for the smallest one
+        candidates = capped or sorted(candidates, key=bitrate)[:1]
+    if candidates:
+        return min(candidates, key=lambda stream: (codec_rank(stream), -bitrate(stream)))
+
+    if video_fallback:
+        return streams.get_highest_resolution()
+    raise RuntimeError("No audio-only stream available.")
 
 
 def set_song_metadata(directory, song_properties, song_filename, save_as_mp4):
@@ -103,11 +359,10 @@ def set_song_metadata(directory, song_properties, song_filename, save_as_mp4):
         audio.tags["\xa9ART"] = song_properties["artist"]
         audio.tags["\xa9nam"] = song_properties["song"]
         audio.tags["\xa9gen"] = song_properties["genre"]
-        # Only add a cover if the response was ok and the header of the
-        # response content is that of a JPEG image. Source:
-        # https://www.file-recovery.com/jpg-signature-format.htm.
-        if valid_artwork():
-            audio.tags["covr"] = [MP4Cover(response.content, imageformat=MP4Cover.FORMAT_JPEG)]
+        # Only add a cover if the artwork was fetched and its header
+        # is that of a JPEG image.
+        if valid_artwork(artwork):
+            audio.tags["covr"] = [MP4Cover(artwork, imageformat=MP4Cover.FORMAT_JPEG)]
 
         audio.save()
 
@@ -118,31 +373,22 @@ def set_song_metadata(directory, song_properties, song_filename, save_as_mp4):
         audio["TPE1"] = TPE1(encoding=3, text=song_properties["artist"])
         audio["TIT2"] = TIT2(encoding=3, text=song_properties["song"])
         audio["TCON"] = TCON(encoding=3, text=song_properties["genre"])
-        if valid_artwork():
+        if valid_artwork(artwork):
             audio.tags.add(
                 APIC(
                     encoding=3,  # 3 is for utf-8
                     mime="image/jpeg",  # image/jpeg or image/png
                     type=3,  # 3 is for the cover image
                     desc="Cover",
-                    data=response.content,
+                    data=artwork,
                 )
             )
 
         audio.save()
 
-    def valid_artwork():
-        """Validate artwork requests response."""
-        return response is not None and response.status_code == 200 and response.content[:3] == b"\xff\xd8\xff"
-
-    # TODO Cache the image until program finishes
-    try:
-        # Get byte data for album artwork url. The first number in the timeout
-        # tuple is for the initial connection to the server. The second number
-        # is for the subsequent response from the server.
-        response = requests.get(song_properties["artwork"], timeout=(1, 5))
-    except requests.exceptions.MissingSchema:
-        response = None
+    # Use artwork bytes carried over from iTunes annotation if any, else the
+    # shared artwork cache: every track of an album is fetched once per url
+    artwork = song_properties.get("artwork_bytes") or get_artwork(song_properties["artwork"])
 
     if save_as_mp4:
         write_to_mp4()
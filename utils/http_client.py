@@ -0,0 +1,33 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import config
+from utils.timeout import current_deadline
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Get the process-wide requests session. Connections are pooled per
+    host and kept alive, so repeated requests to YouTube, iTunes and the
+    artwork CDN skip the TCP and TLS handshakes."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=config.HTTP_POOL_HOSTS, pool_maxsize=config.HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def get(url, timeout=None, **kwargs):
+    """GET request through the shared session. Default (connect, read)
+    timeout is config.HTTP_TIMEOUT -- no request waits forever -- cut
+    short by the current deadline. Raise TimeoutError once it expired."""
+    timeout = current_deadline().clamp(timeout or config.HTTP_TIMEOUT)
+    return get_session().get(url, timeout=timeout, **kwargs)
@@ -0,0 +1,129 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from utils import config
+
+try:
+    import fcntl
+except ImportError:  # i.e. Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux ioctl to share data blocks between two files
+
+
+class MediaCache:
+    """On-disk store of encoded (untagged) audio files keyed by video id,
+    stream selection and encoder settings. Entries are evicted least
+    recently used first once the store grows past `max_bytes`."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(video_id, save_as_mp4):
+        """Get cache key of a video's audio in an output format. The stream
+        selection settings stand in for the stream they pick, so a lookup
+        needs no list of the video's streams from YouTube."""
+        selection = (config.AUDIO_CODEC_PREFERENCE, config.AUDIO_MAX_BITRATE, config.VIDEO_FALLBACK)
+        if save_as_mp4:
+            output = ("m4a", "copy")
+        else:
+            output = ("mp3", *config.MP3_ENCODER_ARGS)
+        key = json.dumps([video_id, *selection, *output])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key, target_path):
+        """Copy cached file of key to target_path. Return False on a miss."""
+        if not self.max_bytes:
+            return False
+        entry = self.entry_path(key, target_path)
+        try:
+            clone_file(entry, target_path)
+            os.utime(entry)  # mark as recently used
+        except OSError:  # missing, or the cache is unreadable
+            return False
+        return True
+
+    def put(self, key, source_path):
+        """Store a copy of source_path under key, then evict old entries.
+        Skipped if the cache can't be written, e.g. the disk is full."""
+        if not self.max_bytes:
+            return
+        entry = self.entry_path(key, source_path)
+        temp_entry = f"{entry}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            clone_file(source_path, temp_entry)
+            os.replace(temp_entry, entry)  # never expose a half-written entry
+            self.evict()
+        except OSError as error:
+            print(f"Error: not cached: {str(error)}")  # poor man's logging
+            with contextlib.suppress(OSError):
+                os.remove(temp_entry)
+
+    def evict(self):
+        """Remove least recently used entries until the store fits max_bytes."""
+        with self.lock:
+            evict_lru(self.directory, self.max_bytes)
+
+    def entry_path(self, key, audio_path):
+        """Get path of cache entry -- keeps the audio file extension."""
+        extension = os.path.splitext(audio_path)[1]
+        return os.path.join(self.directory, key[:2], f"{key}{extension}")
+
+
+def clone_file(source_path, target_path):
+    """Copy a file, sharing its data blocks (reflink) where the file system
+    supports it. Not a hard link: tagging writes to the copy in place and
+    must not change the original."""
+    if fcntl is not None:
+        with open(source_path, "rb") as source, open(target_path, "wb") as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return target_path
+            except OSError:
+                pass  # e.g. ext4 or across file systems -- copy below
+    shutil.copyfile(source_path, target_path)
+    return target_path
+
+
+def evict_lru(directory, max_bytes):
+    """Remove least recently modified files under directory until their
+    total size fits max_bytes."""
+    entries = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(".tmp"):
+                continue  # still being written
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # removed meanwhile
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
+
+
+_media_cache = None
+_media_cache_lock = threading.Lock()
+
+
+def get_media_cache():
+    """Get the process-wide media cache."""
+    global _media_cache
+    with _media_cache_lock:
+        if _media_cache is None:
+            _media_cache = MediaCache(os.path.join(config.CACHE_DIR, "media"), config.MEDIA_CACHE_MAX_BYTES)
+    return _media_cache
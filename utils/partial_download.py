@@ -0,0 +1,178 @@
+import concurrent.futures
+import contextlib
+import json
+import os
+import threading
+
+from utils import config, http_client
+from utils.timeout import in_context
+
+
+def download_resumable(url, path, filesize, segments=None):
+    """Download `url` to `path` in Range requests. Bytes land in
+    `path + ".part"` next to a JSON sidecar recording the url, expected
+    size and bytes received, so an interrupted download continues where
+    it stopped on the next call instead of starting from byte zero.
+    Streams of at least SEGMENT_THRESHOLD bytes are split in `segments`
+    byte ranges fetched concurrently into the preallocated file."""
+    if os.path.isfile(path) and os.path.getsize(path) == filesize:
+        return path  # completed on an earlier run
+
+    part_path = f"{path}.part"
+    state = read_sidecar(part_path, filesize)
+    if state is None:
+        state = new_state(filesize, segments)
+        with open(part_path, "wb") as file:
+            file.truncate(filesize)  # preallocate so segments can be written in place
+    # signed stream urls expire -- keep the fresh one, the bytes are the same
+    state["url"] = url
+    lock = threading.Lock()
+    pending = [segment for segment in state["segments"] if not segment_complete(segment)]
+    try:
+        if len(pending) > 1:
+            # own short-lived pool: this may already run on a shared worker thread
+            with concurrent.futures.ThreadPoolExecutor(len(pending)) as executor:
+                futures = [
+                    executor.submit(in_context(fetch_segment), url, part_path, segment, state, lock)
+                    for segment in pending
+                ]
+            for future in futures:
+                future.result()  # raise the first error, if any
+        elif pending:
+            fetch_segment(url, part_path, pending[0], state, lock)
+    finally:
+        with lock:
+            write_sidecar(part_path, state)
+
+    verify_complete(part_path, state)
+    os.replace(part_path, path)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(sidecar_path(part_path))
+    return path
+
+
+def new_state(filesize, segments=None):
+    """Split a download of `filesize` bytes into [start, end, received]
+    byte ranges -- a single one below SEGMENT_THRESHOLD."""
+    segments = segments or config.DOWNLOAD_SEGMENTS
+    if filesize < config.SEGMENT_THRESHOLD:
+        segments = 1
+    size = -(-filesize // segments)  # ceiling division
+    ranges = [[start, min(start + size, filesize) - 1, 0] for start in range(0, filesize, size)]
+    return {"url": None, "filesize": filesize, "segments": ranges}
+
+
+def fetch_segment(url, part_path, segment, state, lock):
+    """Fetch one byte range of the stream into the partial file, saving
+    progress to the sidecar after every chunk."""
+    with open(part_path, "r+b") as file:
+        while not segment_complete(segment):
+            fetch_range(url, file, segment, lock)
+            with lock:
+                write_sidecar(part_path, state)
+
+
+def fetch_range(url, file, segment, lock):
+    """Fetch the next chunk of a segment into `file`, counting bytes in
+    the segment once they are flushed -- other segments' threads save the
+    whole state meanwhile. YouTube throttles large ranges, so ask for at
+    most DOWNLOAD_CHUNK_SIZE."""
+    segment_start, segment_end, received = segment
+    start = segment_start + received
+    end = min(start + config.DOWNLOAD_CHUNK_SIZE - 1, segment_end)
+    headers = {"Range": f"bytes={start}-{end}"}
+    written = 0
+    try:
+        with http_client.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206 and start:
+                # server ignored the Range header -- the body starts at byte zero
+                raise RuntimeError(f"Server does not support resuming {url}")
+            file.seek(start)
+            remaining = end + 1 - start
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                # a server ignoring the Range header sends more than asked for
+                chunk = chunk[:remaining]
+                file.write(chunk)
+                written += len(chunk)
+                remaining -= len(chunk)
+                if not remaining:
+                    break
+    finally:
+        file.flush()  # never record bytes that are not written yet
+        with lock:
+            segment[2] += written
+    if not written:
+        raise RuntimeError(f"No bytes received from {url}")
+
+
+def iter_download(url, filesize=None):
+    """Yield the bytes of `url` as they arrive, in Range requests of at
+    most DOWNLOAD_CHUNK_SIZE if `filesize` is known, else in one request.
+    Unlike pytube's, every request times out (see http_client.get)."""
+    start = 0
+    while start < (filesize or 1):
+        headers = {}
+        if filesize:
+            end = min(start + config.DOWNLOAD_CHUNK_SIZE, filesize) - 1
+            headers["Range"] = f"bytes={start}-{end}"
+        received = 0
+        with http_client.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206 and start:
+                # server ignored the Range header -- the body starts at byte zero
+                raise RuntimeError(f"Server does not support resuming {url}")
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                received += len(chunk)
+                yield chunk
+        if not received:
+            raise RuntimeError(f"No bytes received from {url}")
+        if not filesize:
+            return  # size unknown -- the whole stream came in one response
+        start += received
+
+
+def segment_complete(segment):
+    """Check if all bytes of a [start, end, received] segment are in."""
+    start, end, received = segment
+    return received >= end - start + 1
+
+
+def verify_complete(part_path, state):
+    """Raise RuntimeError unless the segments cover the whole stream and
+    every byte of them was received."""
+    segments = sorted(state["segments"])
+    expected_start = 0
+    for segment in segments:
+        if segment[0] != expected_start or not segment_complete(segment):
+            raise RuntimeError(f"Incomplete download {part_path}")
+        expected_start = segment[1] + 1
+    if expected_start != state["filesize"] or os.path.getsize(part_path) != state["filesize"]:
+        raise RuntimeError(f"Incomplete download {part_path}")
+
+
+def read_sidecar(part_path, filesize):
+    """Get the download state of a partial file, None if the sidecar is
+    missing or describes a different stream."""
+    try:
+        with open(sidecar_path(part_path)) as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if state.get("filesize") != filesize or "segments" not in state or not os.path.isfile(part_path):
+        return None
+    return state
+
+
+def write_sidecar(part_path, state):
+    """Save the download state of a partial file -- replaced whole, so a
+    crash never leaves a truncated sidecar."""
+    temp_path = f"{sidecar_path(part_path)}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(state, file)
+    os.replace(temp_path, sidecar_path(part_path))
+
+
+def sidecar_path(part_path):
+    """Get path to the JSON sidecar of a partial file."""
+    return f"{part_path}.json"
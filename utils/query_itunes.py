@@ -1,41 +1,55 @@
+import os
+import threading
 from json.decoder import JSONDecodeError
 
 import itunespy
 import requests
 
+from utils import config, http_client
+from utils.artwork_cache import get_artwork, valid_artwork
+from utils.rate_limit import RateLimiter
+from utils.single_flight import SingleFlight
+from utils.sqlite_cache import SQLiteCache
+
+ITUNES_SEARCH_URL = "https://itunes.apple.com/search"
+
+_itunes_lookups = SingleFlight()
+
 
 def thread_query_itunes(args):
     row_index = args[0]
     key_value = args[1]
     url_id = key_value[1]["id"]
     vid_url = f"https://www.youtube.com/watch?v={url_id}"
-    ITUNES_META_JSON = get_itunes_metadata(vid_url)
+    search_term = video_search_term(*key_value)
+    ITUNES_META_JSON = get_itunes_metadata(vid_url, search_term)
 
     return (row_index, ITUNES_META_JSON)
 
 
-def get_itunes_metadata(vid_url):
-    """Get iTunes metadata to add to MP3/MP4 file."""
-    vid_title = oembed_title(vid_url)
-    try:
-        ITUNES_META = query_itunes(vid_title)[0]
-    except TypeError:  # i.e. no information fetched from query_itunes
-        return None
+def video_search_term(title, video):
+    """Get iTunes search term from a loaded video record: "artist track" if
+    yt-dlp recognized the song, else the video title. None if neither is
+    known -- the title is then fetched from oEmbed."""
+    artist = video.get("artist")
+    track = video.get("track")
+    if artist and track:
+        return f"{artist} {track}"
+    return title or None
 
-    ITUNES_META_JSON = {
-        "track_name": ITUNES_META.track_name,
-        "album_name": ITUNES_META.collection_name,
-        "artist_name": ITUNES_META.artist_name,
-        "primary_genre_name": ITUNES_META.primary_genre_name,
-        "artwork_url_fullres": ITUNES_META.artwork_url_60.replace(
-            "60", "600"
-        ),  # manually replace album artwork to 600x600
-    }
 
-    # get artwork content from iTunes artwork url
-    response = requests.get(ITUNES_META_JSON["artwork_url_fullres"])
-    album_img = response.content
-    ITUNES_META_JSON["artwork_bytes_fullres"] = album_img
+def get_itunes_metadata(vid_url, search_term=None):
+    """Get iTunes metadata to add to MP3/MP4 file. Search for search_term,
+    or the video title from oEmbed if it is not given."""
+    vid_title = search_term or oembed_title(vid_url)
+    ITUNES_META_JSON = lookup_itunes_metadata(vid_title)
+    if ITUNES_META_JSON is None:  # i.e. no information fetched from iTunes
+        return None
+
+    # get artwork content from iTunes artwork url -- through the shared
+    # artwork cache, so tagging and display reuse these bytes
+    album_img = get_artwork(ITUNES_META_JSON["artwork_url_fullres"])
+    ITUNES_META_JSON["artwork_bytes_fullres"] = album_img if valid_artwork(album_img) else None
 
     return ITUNES_META_JSON
 
@@ -49,9 +63,9 @@ def oembed_title(vid_url):
         # of a URL on third party sites.
         oembed_url = f"https://www.youtube.com/oembed?url={vid_url}&format=json"
         try:
-            vid_content = requests.get(oembed_url)
+            vid_content = http_client.get(oembed_url)
             vid_json = vid_content.json()
-        except (requests.exceptions.ConnectionError, JSONDecodeError):
+        except (requests.exceptions.RequestException, JSONDecodeError):
             return None
 
         return vid_json["title"]
@@ -59,13 +73,113 @@ def oembed_title(vid_url):
     raise TypeError("vid_url must be a URL string.")
 
 
+def lookup_itunes_metadata(search_term):
+    """Get metadata of the best iTunes match for search_term, None if there
+    is none. Answers from the local lookup cache while it is fresh, and
+    concurrent lookups of the same term share one search."""
+    if not search_term:
+        return None
+    cache_key = normalize_query(search_term)
+    # rows of a compilation often search the same term at once: one request
+    ITUNES_META_JSON, _ = _itunes_lookups.do(cache_key, search_itunes_metadata, search_term, cache_key)
+    # a copy per row -- callers add their own artwork bytes to it
+    return dict(ITUNES_META_JSON) if ITUNES_META_JSON is not None else None
+
+
+def search_itunes_metadata(search_term, cache_key):
+    """Get metadata of the best iTunes match for search_term from the
+    lookup cache, else from the iTunes Search API."""
+    itunes_cache = get_itunes_cache()
+    is_cached, ITUNES_META_JSON = itunes_cache.get(cache_key)
+    if is_cached:
+        return ITUNES_META_JSON
+
+    try:
+        ITUNES_META = search_track(search_term)[0]
+    except LookupError:
+        # no match: remembered for the shorter negative TTL
+        itunes_cache.put(cache_key, None)
+        return None
+    except Exception:  # connection or server trouble -- worth asking again
+        return None
+
+    ITUNES_META_JSON = {
+        "track_name": ITUNES_META.track_name,
+        "album_name": ITUNES_META.collection_name,
+        "artist_name": ITUNES_META.artist_name,
+        "primary_genre_name": ITUNES_META.primary_genre_name,
+        "artwork_url_fullres": ITUNES_META.artwork_url_60.replace(
+            "60", "600"
+        ),  # manually replace album artwork to 600x600
+    }
+    itunes_cache.put(cache_key, ITUNES_META_JSON)
+    return ITUNES_META_JSON
+
+
+def normalize_query(search_term):
+    """Normalize search term for cache lookups: case and spacing don't matter."""
+    return " ".join(search_term.casefold().split())
+
+
 def query_itunes(song_properties):
     """Download video metadata using itunespy."""
     try:
-        song_itunes = itunespy.search_track(song_properties)
+        song_itunes = search_track(song_properties)
         # Before returning convert all the track_time values to minutes.
         for song in song_itunes:
             song.track_time = round(song.track_time / 60000, 2)
         return song_itunes
     except Exception:
         return None
+
+
+def search_track(term):
+    """Search iTunes songs like itunespy.search_track, but through the
+    shared HTTP session and the iTunes rate limiter."""
+    params = {"term": term, "country": "US", "media": "music", "entity": "song", "limit": 50}
+    response = get_itunes_rate_limiter().get(ITUNES_SEARCH_URL, params=params)
+    response.raise_for_status()
+    results = response.json()["results"]
+    tracks = [itunespy.track.Track(item) for item in results if item.get("wrapperType") == "track"]
+    if not tracks:
+        raise LookupError(f"No results found with the keyword {term}")
+    return tracks
+
+
+_itunes_cache = None
+_itunes_cache_lock = threading.Lock()
+
+
+def get_itunes_cache():
+    """Get the process-wide iTunes lookup cache."""
+    global _itunes_cache
+    with _itunes_cache_lock:
+        if _itunes_cache is None:
+            _itunes_cache = SQLiteCache(
+                os.path.join(config.CACHE_DIR, "itunes.sqlite3"),
+                "itunes_lookup",
+                config.ITUNES_CACHE_TTL,
+                config.ITUNES_CACHE_NEGATIVE_TTL,
+                config.ITUNES_CACHE_MAX_ENTRIES,
+            )
+    return _itunes_cache
+
+
+_itunes_rate_limiter = None
+_itunes_rate_limiter_lock = threading.Lock()
+
+
+def get_itunes_rate_limiter():
+    """Get the process-wide limiter of iTunes Search API requests."""
+    global _itunes_rate_limiter
+    with _itunes_rate_limiter_lock:
+        if _itunes_rate_limiter is None:
+            _itunes_rate_limiter = RateLimiter(
+                config.ITUNES_RATE_LIMIT,
+                config.ITUNES_RATE_BURST,
+                config.ANNOTATE_CONCURRENCY,
+                config.ITUNES_MAX_RETRIES,
+                config.BACKOFF_BASE,
+                config.BACKOFF_CAP,
+            )
+    return _itunes_rate_limiter
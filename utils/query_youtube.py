@@ -1,71 +1,289 @@
-import re
-import urllib
+import json
+import os
+import threading
+import time
+import urllib.parse
 
 import yt_dlp
-from pytube import Playlist
-from utils._threading import map_threads
+
+from utils import config
+from utils.rate_limit import backoff_delay
+from utils.sqlite_cache import SQLiteCache
+from utils.timeout import Deadline, current_deadline, deadline_scope, iter_with_deadline
+from utils.video_records import VideoRecord, VideoRecords
+
+_youtube_dls = threading.local()  # YoutubeDL instances are not thread safe
+
+# titles of playlist entries whose video can't be watched
+UNAVAILABLE_TITLES = ("[Private video]", "[Deleted video]")
+# error messages of loads that fail the same way however often retried
+PERMANENT_ERRORS = ("not a valid URL", "Unsupported URL", "Private video", "Video unavailable", "has been removed")
 
 
 def get_youtube_content(youtube_url, override_error):
     """Str parse YouTube url and call appropriate functions
     to execute url content."""
+    video_records = VideoRecords()
+    for _, record in iter_youtube_content(youtube_url, override_error):
+        if isinstance(record, Exception):
+            raise record
+        video_records.add(record)
+    return video_records
+
+
+def iter_youtube_content(youtube_url, override_error):
+    """Yield (video id, VideoRecord) of each video at youtube_url as soon as
+    it is resolved -- a playlist yields page by page while it loads. A video
+    that can't be loaded yields (video id, RuntimeError), or is skipped if
+    override_error. Raise RuntimeError if the url can't be loaded at all."""
     if ".com/playlist" in youtube_url:
-        url_tuple = get_playlist_video_info(youtube_url)
-        # concatenate override_error argument to url_tuple
-        url_tuple = tuple((url, override_error) for url in url_tuple)
-        video_genr = map_threads(get_video_info, url_tuple)
-        video_info = list(video_genr)
+        for video_id, video in iter_playlist_records(youtube_url):
+            if video is None:  # i.e. private or deleted
+                if not override_error:
+                    yield video_id, RuntimeError(f"Video unavailable: {video_id}")
+                continue
+            yield video_id, VideoRecord.from_info(video)
     else:
         adj_youtube_url = youtube_url.split("&")[0]  # trim ascii encoding "&"
         # set get_video_info parameter as tuple to comply with multithreading parameter (tuple)
         url_tuple = (adj_youtube_url, override_error)
         video_json = get_video_info(url_tuple)
-        video_info = [video_json]
+        if video_json:  # i.e. not an ignored error
+            yield video_json["id"], VideoRecord.from_info(video_json)
+
+
+def iter_youtube_content_retrying(youtube_url, max_retries=None, deadline=None, on_retry=None):
+    """Yield (video id, VideoRecord | RuntimeError) like iter_youtube_content,
+    retrying what fails with jittered exponential backoff instead of
+    reloading everything: a failed url load resumes without yielding loaded
+    videos again, and failed videos are retried one by one once the rest
+    is loaded. Permanent errors (e.g. private videos) are not retried.
+    Nothing is retried after max_retries attempts, and nothing is loaded
+    after `deadline` seconds -- the url error is raised, video errors are
+    yielded. `on_retry(error)` is called before each retry."""
+    max_retries = max_retries if max_retries is not None else config.URL_LOAD_RETRIES
+    deadline = Deadline(deadline or config.URL_LOAD_DEADLINE)
+
+    def wait_to_retry(attempt, error):
+        """Sleep before retrying, False if out of attempts or time."""
+        delay = backoff_delay(attempt, config.BACKOFF_BASE, config.BACKOFF_CAP)
+        if attempt >= max_retries or is_permanent_error(error) or delay >= deadline.remaining():
+            return False
+        if on_retry:
+            on_retry(error)
+        time.sleep(delay)
+        return True
+
+    loaded = set()
+    failed = {}
+    attempt = 0
+    while True:
+        try:
+            videos = iter_youtube_content(youtube_url, override_error=False)
+            for video_id, record in iter_with_deadline(videos, deadline):
+                if video_id in loaded or video_id in failed:
+                    continue  # i.e. yielded before the url load was retried
+                if isinstance(record, Exception):
+                    failed[video_id] = record
+                    continue
+                loaded.add(video_id)
+                yield video_id, record
+            break
+        except RuntimeError as error:
+            if not wait_to_retry(attempt, error):
+                raise
+            attempt += 1
+
+    for video_id, error in failed.items():
+        attempt = 0
+        while wait_to_retry(attempt, error):
+            attempt += 1
+            try:
+                with deadline_scope(deadline):
+                    video_info = get_video_info((f"https://www.youtube.com/watch?v={video_id}", False))
+                error = VideoRecord.from_info(video_info)
+                break
+            except RuntimeError as retry_error:
+                error = retry_error
+        yield video_id, error
 
-    return video_content_to_dict(video_info)
+
+def is_permanent_error(error):
+    """Check if retrying can't help, e.g. the url or the video is invalid."""
+    return any(message in str(error) for message in PERMANENT_ERRORS)
+
+
+def iter_playlist_records(playlist_url):
+    """Yield (video id, video) of each video in a YouTube playlist -- video
+    is None if it is unavailable. The membership is read afresh on every
+    load, which takes a few requests however long the playlist is, and
+    stored once fully loaded for get_playlist_changes. Videos in the video
+    cache keep their cached metadata."""
+    video_cache = get_video_cache()
+    # id, title and duration of every video from the paged playlist
+    # data -- the videos themselves are only extracted to download
+    video_ids = []
+    for entry in iter_playlist_entries(playlist_url):
+        video_ids.append(entry.get("id"))
+        if entry.get("title") in UNAVAILABLE_TITLES:
+            yield video_ids[-1], None
+            continue
+        is_cached, video = video_cache.get(video_ids[-1])
+        yield video_ids[-1], video if is_cached else trim_video_info(entry)
+
+    playlist_cache = get_playlist_cache()
+    cache_key = playlist_key(playlist_url)
+    _, cached = playlist_cache.get(cache_key)
+    playlist_cache.put(cache_key, {"video_ids": video_ids, "previous_ids": cached["video_ids"] if cached else []})
+
+
+def get_playlist_changes(playlist_url):
+    """Get (added, removed) video ids of a playlist between its last two
+    loads, None if it was not loaded before."""
+    _, cached = get_playlist_cache().get(playlist_key(playlist_url))
+    if not cached:
+        return None
+    added = tuple(video_id for video_id in cached["video_ids"] if video_id not in cached["previous_ids"])
+    removed = tuple(video_id for video_id in cached["previous_ids"] if video_id not in cached["video_ids"])
+    return added, removed
+
+
+def playlist_key(playlist_url):
+    """Get playlist cache key of playlist url: its list id, if any."""
+    list_ids = urllib.parse.parse_qs(urllib.parse.urlparse(playlist_url).query).get("list")
+    return list_ids[0] if list_ids else playlist_url
 
 
 def get_playlist_video_info(playlist_url):
-    """Get url of videos in a YouTube playlist."""
-    try:
-        playlist = Playlist(playlist_url)
-        playlist._video_regex = re.compile(
-            r"\"url\":\"(/watch\?v=[\w-]*)"
-        )  # important bug fix with recent YouTube update. See https://github.com/get-pytube/pytube3/pull/90
-    # thrown if poor internet connection or bad playlist url
-    except (urllib.error.URLError, KeyError) as error:
-        raise RuntimeError(error)
+    """Get url of videos in a YouTube playlist -- unavailable videos are
+    skipped."""
+    videos = iter_youtube_content(playlist_url, override_error=True)
+    return tuple(f"https://www.youtube.com/watch?v={video_id}" for video_id, _ in videos)
+
 
+def iter_playlist_entries(playlist_url):
+    """Yield flat entries of a YouTube playlist while its pages load. Raise
+    RuntimeError once the current deadline expired."""
+    ydl_opts = {
+        "extract_flat": "in_playlist",
+        "ignoreerrors": False,
+        "quiet": True,
+        "socket_timeout": config.HTTP_TIMEOUT[1],
+    }
     try:
-        video_urls = tuple(playlist.video_urls)
-    except AttributeError as error:
-        # if videos were queried unsuccessfully in playlist
+        # unprocessed, the entries are a generator fetching one page at a time
+        current_deadline().check()
+        playlist_info = get_youtube_dl(ydl_opts).extract_info(playlist_url, download=False, process=False)
+        for entry in playlist_info.get("entries") or ():
+            current_deadline().check()  # i.e. before the next page is fetched
+            if entry:
+                yield entry
+    # thrown if poor internet connection, bad playlist url or out of time
+    except (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError, UnicodeError, TimeoutError) as error:
         raise RuntimeError(error)
 
-    return video_urls
-
 
 def get_video_info(args):
-    """Get YouTube video metadata."""
+    """Get YouTube video metadata -- trimmed to what is shown and
+    downloaded, and reused from the video cache while it is fresh."""
     video_url = args[0]
     override_error = args[1]
 
-    ydl_opts = {"ignoreerrors": False, "quiet": True}
-    if override_error:
-        # silence youtube_dl exceptions by ignoring errors
-        ydl_opts = {"ignoreerrors": True, "quiet": True}
+    video_cache = get_video_cache()
+    video_id = url_video_id(video_url)
+    if video_id:
+        is_cached, video_info = video_cache.get(video_id)
+        if is_cached:
+            return video_info
+
+    # silence youtube_dl exceptions by ignoring errors if override_error
+    ydl_opts = {"ignoreerrors": bool(override_error), "quiet": True, "socket_timeout": config.HTTP_TIMEOUT[1]}
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            video_info = ydl.extract_info(video_url, download=False)
+        current_deadline().check()
+        video_info = get_youtube_dl(ydl_opts).extract_info(video_url, download=False)
+        if not video_info:  # i.e. an ignored error
+            return None
+        video_info = trim_video_info(video_info)
+        video_cache.put(video_info["id"], video_info)
         return video_info
-    # video unavailable or bad url format
-    except (yt_dlp.utils.DownloadError, UnicodeError) as error:
+    # video unavailable, bad url format or out of time
+    except (yt_dlp.utils.DownloadError, UnicodeError, TimeoutError) as error:
         # catch exception here and process error:
         # either load content again or post error label.
         raise RuntimeError(error)
 
 
-def video_content_to_dict(vid_info_list):
-    """Convert YouTube metadata list to dictionary."""
-    return {video["title"]: {"id": video["id"], "duration": video["duration"]} for video in vid_info_list if video}
+def get_youtube_dl(ydl_opts):
+    """Get this thread's YoutubeDL instance for ydl_opts, created on first
+    use. Reusing it skips setting up the extractors, cookie jar and HTTP
+    opener per video; each set of options gets its own instance, so
+    `ignoreerrors` modes never mix."""
+    instances = _youtube_dls.__dict__.setdefault("instances", {})
+    key = json.dumps(ydl_opts, sort_keys=True, default=repr)
+    if key not in instances:
+        instances[key] = yt_dlp.YoutubeDL(dict(ydl_opts))
+    return instances[key]
+
+
+# song fields yt-dlp extracts for music videos -- kept for iTunes searches
+SONG_FIELDS = ("track", "artist", "album")
+
+
+def trim_video_info(video_info):
+    """Keep the YouTube metadata worth caching: id, title, duration and
+    song fields. Formats are not kept -- downloads pick their stream from
+    pytube, and the media cache needs none."""
+    return {
+        "id": video_info["id"],
+        "title": video_info.get("title"),
+        "duration": video_info.get("duration"),
+        **{field: video_info[field] for field in SONG_FIELDS if video_info.get(field)},
+    }
+
+
+def url_video_id(video_url):
+    """Get video id of a watch or youtu.be url, None if there is none."""
+    parsed_url = urllib.parse.urlparse(video_url)
+    if parsed_url.netloc.endswith("youtu.be"):
+        return parsed_url.path.lstrip("/") or None
+    video_ids = urllib.parse.parse_qs(parsed_url.query).get("v")
+    return video_ids[0] if video_ids else None
+
+
+def video_content_to_records(vid_info_list):
+    """Convert YouTube metadata list to VideoRecords."""
+    return VideoRecords(VideoRecord.from_info(video) for video in vid_info_list if video)
+
+
+_video_cache = None
+_playlist_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_video_cache():
+    """Get the process-wide cache of trimmed video metadata by video id."""
+    global _video_cache
+    with _cache_lock:
+        if _video_cache is None:
+            _video_cache = SQLiteCache(
+                os.path.join(config.CACHE_DIR, "youtube.sqlite3"),
+                "video_info",
+                config.VIDEO_CACHE_TTL,
+                max_entries=config.VIDEO_CACHE_MAX_ENTRIES,
+            )
+    return _video_cache
+
+
+def get_playlist_cache():
+    """Get the process-wide cache of playlist membership by list id."""
+    global _playlist_cache
+    with _cache_lock:
+        if _playlist_cache is None:
+            _playlist_cache = SQLiteCache(
+                os.path.join(config.CACHE_DIR, "youtube.sqlite3"),
+                "playlist_video_ids",
+                config.VIDEO_CACHE_TTL,
+                max_entries=config.PLAYLIST_CACHE_MAX_ENTRIES,
+            )
+    return _playlist_cache
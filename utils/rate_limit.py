@@ -0,0 +1,133 @@
+import collections
+import contextlib
+import random
+import threading
+import time
+
+from utils import http_client
+from utils.timeout import current_deadline
+
+# responses with which upstreams tell a client to slow down
+THROTTLE_STATUS_CODES = (403, 429)
+
+
+class RateLimiter:
+    """Thread-safe limiter of requests to one upstream: a token bucket
+    allows `rate` requests per second with bursts of `burst`, and at most
+    `concurrency` requests run at once. The concurrency limit adapts
+    (AIMD): it grows by one per round of successful requests up to
+    `max_concurrency`, and halves whenever the upstream throttles."""
+
+    def __init__(self, rate, burst, max_concurrency, max_retries=4, backoff_base=1.0, backoff_cap=30.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.concurrency = float(max_concurrency)
+        self.active = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.stats = collections.Counter()  # outcome of every request made
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a token and a concurrency slot for one request."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self):
+        """Wait for a token and a concurrency slot. Raise TimeoutError if
+        the current deadline expires first."""
+        deadline = current_deadline()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:  # upstream asked to wait
+                    self.condition.wait(deadline.clamp(self.paused_until - now))
+                elif self.active >= int(self.concurrency):
+                    self.condition.wait(deadline.clamp(None))  # until a request finishes
+                elif self.tokens < 1:
+                    self.condition.wait(deadline.clamp((1 - self.tokens) / self.rate))
+                else:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def record_success(self):
+        """Additive increase: one more slot per round of successes."""
+        with self.condition:
+            self.stats["succeeded"] += 1
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def record_throttle(self, retry_after=None):
+        """Multiplicative decrease, and pause every request for
+        retry_after seconds if the upstream said so."""
+        with self.condition:
+            self.stats["throttled"] += 1
+            self.concurrency = max(1.0, self.concurrency / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def record(self, outcome):
+        """Count a request outcome that doesn't change the limits."""
+        with self.condition:
+            self.stats[outcome] += 1
+
+    def backoff_delay(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+
+    def get(self, url, **kwargs):
+        """GET request through the shared session within the limits.
+        Throttled requests are retried up to max_retries times with
+        backoff; the last response is returned if all are throttled. Only
+        2xx and 3xx responses count as successes. Raise TimeoutError once
+        the current deadline expired."""
+        for attempt in range(self.max_retries + 1):
+            with self.slot():
+                try:
+                    response = http_client.get(url, **kwargs)
+                except Exception:
+                    self.record("failed")  # e.g. connection error or timeout
+                    raise
+            if response.status_code not in THROTTLE_STATUS_CODES:
+                if response.status_code < 400:
+                    self.record_success()
+                else:
+                    self.record("failed")
+                return response
+            self.record_throttle(retry_after(response))
+            if attempt < self.max_retries:
+                self.record("retried")
+                time.sleep(current_deadline().clamp(self.backoff_delay(attempt)))
+        self.record("gave_up")
+        print(f"Error: still throttled after {self.max_retries} retries: {url}")  # poor man's logging
+        return response
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff with full jitter, so throttled clients don't
+    retry in lockstep: seconds to wait before retry number attempt + 1."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retry_after(response):
+    """Get seconds to wait from a Retry-After header, None if absent or
+    not in seconds."""
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
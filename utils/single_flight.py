@@ -0,0 +1,36 @@
+import concurrent.futures
+import threading
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key: the first caller runs
+    the function, later callers wait for it and share its result or
+    exception. Nothing is kept once the call returns -- pair with a cache
+    to reuse results after that."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs) unless a call with key is in flight.
+        Return (result, shared) -- shared is True if another caller ran it."""
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = concurrent.futures.Future()
+        if not leader:
+            return future.result(), True  # raises the leader's exception too
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self.lock:
+                del self.in_flight[key]
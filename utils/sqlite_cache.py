@@ -0,0 +1,77 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SQLiteCache:
+    """Persistent key-value store of JSON values in a SQLite table. Entries
+    expire after `ttl` seconds, or `negative_ttl` seconds if the value is
+    None (i.e. a lookup that found nothing). Past `max_entries`, the least
+    recently stored entries are evicted. Safe to share between threads."""
+
+    def __init__(self, path, table, ttl, negative_ttl=None, max_entries=None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self.max_entries = max_entries
+        self.local = threading.local()  # sqlite3 connections are per thread
+        self.lock = threading.Lock()
+
+    def connection(self):
+        """Get this thread's connection, creating the table if needed."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")  # readers don't wait on writers
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(key TEXT PRIMARY KEY, value TEXT, stored_at REAL, expires_at REAL)"
+            )
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_stored_at ON {self.table} (stored_at)")
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        """Get (hit, value) of key -- hit is False if missing or expired."""
+        try:
+            row = (
+                self.connection()
+                .execute(f"SELECT value FROM {self.table} WHERE key = ? AND expires_at > ?", (key, time.time()))
+                .fetchone()
+            )
+        except (sqlite3.Error, OSError):  # e.g. locked or unreadable -- a cache is never essential
+            return False, None
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def put(self, key, value):
+        """Store a JSON serializable value under key, then evict."""
+        now = time.time()
+        ttl = self.ttl if value is not None else self.negative_ttl
+        try:
+            connection = self.connection()
+            with self.lock, connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now, now + ttl),
+                )
+                self.evict(connection, now)
+        except (sqlite3.Error, OSError):
+            pass  # not stored -- looked up again next time
+
+    def evict(self, connection, now):
+        """Remove expired entries, then the oldest past max_entries."""
+        connection.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+        if self.max_entries:
+            connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
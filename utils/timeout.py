@@ -1,26 +1,146 @@
+import contextlib
+import contextvars
 import errno
 import os
-import signal
+import threading
+import time
 from functools import wraps
 
+_current_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class Deadline:
+    """A point in time after which work should be given up. Thread and
+    asyncio safe: it is only read after creation. `seconds` of None never
+    expires."""
+
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds=None):
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        """Get seconds left (never below 0), None if unlimited."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self, error_message="Deadline exceeded"):
+        """Raise TimeoutError if expired."""
+        if self.expired():
+            raise TimeoutError(error_message)
+
+    def clamp(self, seconds):
+        """Get the shorter of `seconds` and the time left -- a (connect,
+        read) tuple of requests timeouts is clamped element-wise. Raise
+        TimeoutError if already expired."""
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        if isinstance(seconds, tuple):
+            return tuple(self.clamp(part) for part in seconds)
+        return remaining if seconds is None else min(seconds, remaining)
+
+    def __repr__(self):
+        return f"Deadline(remaining={self.remaining()})"
+
+
+def current_deadline():
+    """Get the deadline of the current batch -- unlimited outside of
+    deadline_scope. Carried by contextvars, so it follows work submitted
+    with in_context and asyncio tasks."""
+    return _current_deadline.get() or Deadline()
+
+
+@contextlib.contextmanager
+def deadline_scope(seconds):
+    """Run the block under a deadline of `seconds` (None for unlimited) or
+    a Deadline, or the enclosing deadline if that is sooner."""
+    deadline = seconds if isinstance(seconds, Deadline) else Deadline(seconds)
+    enclosing = _current_deadline.get()
+    if enclosing is not None and enclosing.expires_at is not None:
+        if deadline.expires_at is None or enclosing.expires_at < deadline.expires_at:
+            deadline = enclosing
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def iter_with_deadline(iterable, seconds):
+    """Iterate with each step run under a deadline (see deadline_scope) --
+    a scope entered in a generator can't be held across its yields."""
+    deadline = seconds if isinstance(seconds, Deadline) else Deadline(seconds)
+    iterator = iter(iterable)
+    while True:
+        with deadline_scope(deadline):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def in_context(func):
+    """Wrap func to run in a copy of the caller's context (its deadline
+    included) on whichever thread calls it. Wrap once per submission: a
+    context can't be entered by two threads at once."""
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def call_with_timeout(func, seconds, *args, **kwargs):
+    """Call func, giving up with TimeoutError after `seconds` (None for
+    never), or when the current deadline expires if sooner. Works on any
+    thread. func runs on a separate daemon thread that is abandoned on
+    timeout: the caller -- often a pool worker -- is free again, though
+    a hung func still runs on until it returns or checks its deadline,
+    which is `seconds` from now."""
+    seconds = current_deadline().clamp(seconds)
+    if seconds is None:
+        return func(*args, **kwargs)
+
+    outcome = {}
+    done = threading.Event()
+
+    def target():
+        try:
+            with deadline_scope(seconds):
+                outcome["result"] = func(*args, **kwargs)
+        except BaseException as error:
+            outcome["error"] = error
+        finally:
+            done.set()
+
+    threading.Thread(target=in_context(target), daemon=True).start()
+    if not done.wait(seconds):
+        raise TimeoutError(f"{getattr(func, '__name__', 'call')} timed out after {seconds:.1f}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
 
 def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
     """A wrapper for request methods. Default time before
-    timeout is 10 seconds - change as necessary. This wrapper
-    will only work in the main thread."""
+    timeout is 10 seconds - change as necessary. Works in
+    any thread: see call_with_timeout."""
 
     def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
-
         def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
             try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
+                return call_with_timeout(func, seconds, *args, **kwargs)
+            except TimeoutError as error:
+                raise TimeoutError(error_message) from error
 
         return wraps(func)(wrapper)
 
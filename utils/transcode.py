@@ -0,0 +1,93 @@
+import contextlib
+import os
+import subprocess
+import tempfile
+
+from moviepy.config import get_setting
+
+from utils import config
+from utils.timeout import current_deadline
+
+
+def ffmpeg_binary():
+    """Get path to the FFmpeg binary used by moviepy."""
+    return get_setting("FFMPEG_BINARY")
+
+
+def output_args(save_as_mp4, audio_codec=None):
+    """FFmpeg output options for the first audio track: a copy into an
+    M4A container if `save_as_mp4`, else an MP3 encode."""
+    if save_as_mp4:
+        # the ipod muxer writes the M4A brand iTunes expects, but only takes AAC
+        muxer = "ipod" if (audio_codec or "mp4a").startswith("mp4a") else "mp4"
+        return ["-map", "0:a:0", "-c:a", "copy", "-movflags", "+faststart", "-f", muxer]
+    return ["-map", "0:a:0", *config.MP3_ENCODER_ARGS, "-f", "mp3"]
+
+
+def transcode_audio(source_path, target_path, save_as_mp4, audio_codec=None, timeout=None):
+    """Write the audio of `source_path` to `target_path` as M4A or MP3.
+    M4A output is a remux: the audio is never decoded or re-encoded, so it
+    costs little more than the file copy. FFmpeg is killed after `timeout`
+    seconds, if given."""
+    command = [ffmpeg_binary(), "-y", "-loglevel", "error", "-i", source_path]
+    command += output_args(save_as_mp4, audio_codec) + [target_path]
+    return run_ffmpeg(command, timeout)
+
+
+def stream_transcode(chunks, target_path, save_as_mp4, audio_codec=None):
+    """Pipe an iterable of downloaded byte chunks into FFmpeg as they
+    arrive, writing M4A or MP3 to `target_path`. Download and encode
+    overlap and no intermediate file is written. Stops with TimeoutError
+    once the current deadline expired, or if FFmpeg is still running
+    config.ENCODE_TIMEOUT seconds after the last chunk."""
+    command = [ffmpeg_binary(), "-y", "-loglevel", "error", "-i", "pipe:0"]
+    command += output_args(save_as_mp4, audio_codec) + [target_path]
+    # stderr goes to a file so a chatty FFmpeg can never block on a full pipe
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        try:
+            deadline = current_deadline()
+            for chunk in chunks:
+                deadline.check()
+                process.stdin.write(chunk)
+            process.stdin.close()
+        except BrokenPipeError:
+            # FFmpeg quit early -- its error is reported below
+            pass
+        except BaseException:
+            # download failed: don't leave a truncated file behind
+            process.kill()
+            process.wait()
+            remove_partial(target_path)
+            raise
+        try:
+            returncode = process.wait(current_deadline().clamp(config.ENCODE_TIMEOUT))
+        except (subprocess.TimeoutExpired, TimeoutError) as error:
+            process.kill()
+            process.wait()
+            remove_partial(target_path)
+            raise TimeoutError("FFmpeg timed out") from error
+        if returncode != 0:
+            stderr.seek(0)
+            remove_partial(target_path)
+            raise RuntimeError(stderr.read().decode(errors="replace").strip())
+    return target_path
+
+
+def remove_partial(path):
+    """Remove a partially written output file, if any."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def run_ffmpeg(command, timeout=None):
+    """Run an FFmpeg command, raise RuntimeError with its output if it fails.
+    FFmpeg is killed and TimeoutError raised after `timeout` seconds."""
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired as error:
+        remove_partial(command[-1])
+        raise TimeoutError(f"FFmpeg timed out after {timeout:.1f}s") from error
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.decode(errors="replace").strip())
+    return command[-1]
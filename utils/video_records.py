@@ -0,0 +1,103 @@
+class VideoRecord:
+    """Metadata of one YouTube video, projected out of the yt-dlp info
+    dict: only the fields shown, searched and downloaded are kept. Reads
+    like the video dicts it replaces -- record["id"], record.get("artist")."""
+
+    __slots__ = ("id", "title", "duration", "track", "artist", "album")
+
+    def __init__(self, id, title, duration=None, track=None, artist=None, album=None):
+        self.id = id
+        self.title = title
+        self.duration = duration
+        self.track = track
+        self.artist = artist
+        self.album = album
+
+    @classmethod
+    def from_info(cls, video_info):
+        """Get record of a yt-dlp info dict (full, flat or trimmed)."""
+        return cls(
+            video_info["id"],
+            video_info.get("title"),
+            video_info.get("duration"),
+            video_info.get("track") or None,
+            video_info.get("artist") or None,
+            video_info.get("album") or None,
+        )
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def to_dict(self):
+        """Get the set fields as a dict."""
+        return {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+
+    def __eq__(self, other):
+        return isinstance(other, VideoRecord) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        # equal records share an id
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"VideoRecord({self.id!r}, {self.title!r})"
+
+
+class VideoRecords:
+    """Ordered collection of VideoRecord keyed by video id -- the same video
+    is only kept once, videos sharing a title are all kept. Index by row
+    with records[row_index], by id with records.get(video_id)."""
+
+    __slots__ = ("_by_id", "_rows")
+
+    def __init__(self, records=()):
+        self._by_id = {}
+        self._rows = []
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """Append record. Return False if its video is already in."""
+        if record.id in self._by_id:
+            return False
+        self._by_id[record.id] = record
+        self._rows.append(record)
+        return True
+
+    def remove(self, video_id):
+        """Remove the record of video_id."""
+        self._rows.remove(self._by_id.pop(video_id))
+
+    def get(self, video_id, default=None):
+        return self._by_id.get(video_id, default)
+
+    def index(self, video_id):
+        """Get row index of the record of video_id."""
+        return self._rows.index(self._by_id[video_id])
+
+    def items(self):
+        """Get (title, record) of every row, in order -- the shape of the
+        (title, video) arguments taken by the iTunes and download threads."""
+        return [(record.title, record) for record in self._rows]
+
+    def __getitem__(self, row_index):
+        return self._rows[row_index]
+
+    def __contains__(self, video_id):
+        return video_id in self._by_id
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return f"VideoRecords({self._rows!r})"